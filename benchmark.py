@@ -0,0 +1,242 @@
+import io
+import sys
+import json
+import time
+import platform
+import resource
+import contextlib
+import numpy as np
+import pandas as pd
+
+
+# modules that are only imported on first use (plotting, SHAP, model fitting), not by the scoring path
+LAZY_MODULES = ['matplotlib','shap','imblearn','sklearn']
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process so far, in MB.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return rss/1024**2 if sys.platform == 'darwin' else rss/1024
+
+
+def _stage(results,name,quiet,fn,rows=None,vectors=None):
+    # runs fn, records wall and cpu time, throughput and peak memory of the stage, returns the output of fn
+    wall,cpu = time.perf_counter(),time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()) if quiet else contextlib.nullcontext():
+        out = fn()
+    wall,cpu = time.perf_counter() - wall,time.process_time() - cpu
+
+    rows = rows(out) if callable(rows) else rows
+    vectors = vectors(out) if callable(vectors) else vectors
+    results.append({'stage':name,'wall_s':wall,'cpu_s':cpu,'rows':rows,'vectors':vectors,
+                    'rows_per_s':rows/wall if rows else None,'vectors_per_s':vectors/wall if vectors else None,
+                    'peak_rss_mb':peak_rss_mb()})
+    print('  {:<26} {:9.2f}s'.format(name,wall),file=sys.stderr)
+
+    return out
+
+
+def benchmark_size(n_patients,pred_window=64,gap=20,int_neg=4,int_pos=4,feature_window=3,n_windows=1000,
+                   train='halving',budget_s=60,random_state=0,quiet=True,cohort={}):
+    """
+    Times every stage of the pipeline on a synthetic cohort of n_patients (see synthetic.make_cohort): generating
+    the cohort, df_preparer, fitting the Imputer, prepare_feature_vectors of the train and validation set,
+    n_windows calls of create_feature_window, balancer, train_model and evaluate_metrics.
+
+    Peak RSS is the peak of the process up to the end of the stage, so run every size in a new process
+    (run_benchmark does).
+
+    Parameters
+    ----------
+    n_patients: int
+        number of patients
+    pred_window, gap, int_neg, int_pos, feature_window:
+        see prepare_feature_vectors
+    n_windows: Optional[int]
+        number of create_feature_window calls, on random feature vectors of the train set
+    train: Optional[str]
+        search of train_model ('grid' or 'halving'), or None to skip training and evaluation
+    budget_s: Optional[float]
+        time budget of the 'halving' search
+    quiet: Optional[bool]
+        if True, hide the prints of the pipeline
+    cohort: Optional[dict]
+        keyword arguments of make_cohort
+
+    Returns
+    -------
+    results: list[dict]
+        per stage: wall and cpu time in seconds, rows and feature vectors processed, rows/s, vectors/s and peak RSS
+    """
+    from synthetic import make_cohort
+    from functions import df_preparer, prepare_feature_vectors, create_feature_window, balancer, train_model, \
+        evaluate_metrics, sampling_plan, split_on_label
+    from classes import Imputer
+
+    print('benchmark:',n_patients,'patients',file=sys.stderr)
+    results = []
+
+    df = _stage(results,'make_cohort',quiet,lambda: make_cohort(n_patients,random_state=random_state,**cohort),
+                rows=len)
+    variables = sorted(df['VARIABLE'].unique())
+
+    df_train,df_val,df_test,df_demo_train,df_demo_val,df_demo_test,_ = _stage(
+        results,'df_preparer',quiet,lambda: df_preparer(df,variables,0.2,0.2,random_state),rows=len(df))
+
+    imputer = _stage(results,'imputer',quiet,lambda: Imputer().Fit(df_train,df_demo_train,variables),rows=len(df_train))
+
+    settings = (pred_window,gap,int_neg,int_pos,feature_window,variables)
+    X_train,y_train = _stage(results,'prepare_feature_vectors',quiet,
+                             lambda: prepare_feature_vectors(df_train,df_demo_train,imputer,*settings),
+                             rows=len(df_train),vectors=lambda out: len(out[1]))
+    X_val,y_val = _stage(results,'prepare_feature_vectors_val',quiet,
+                         lambda: prepare_feature_vectors(df_val,df_demo_val,imputer,*settings),
+                         rows=len(df_val),vectors=lambda out: len(out[1]))
+
+    # create_feature_window on random feature vectors of the train set
+    with contextlib.redirect_stdout(io.StringIO()):
+        plan,_ = sampling_plan(*split_on_label(df_train),pred_window,gap,int_neg,int_pos)
+    sample = plan.iloc[np.random.default_rng(random_state).choice(len(plan),min(n_windows,len(plan)),replace=False)]
+    by_id = dict(tuple(df_train.groupby('ID')))
+
+    def windows():
+        for idx,cutoff in zip(sample['ID'],sample['CUTOFF']):
+            patient = by_id[idx]
+            create_feature_window(patient[patient['TIME'] <= cutoff],df_demo_train,imputer,feature_window,variables,idx)
+        return len(sample)
+
+    _stage(results,'create_feature_window',quiet,windows,vectors=lambda n: n)
+
+    X_bal,y_bal = _stage(results,'balancer',quiet,lambda: balancer(X_train,y_train),vectors=len(y_train))
+
+    if train is not None and len(np.unique(y_bal)) == 2:
+        model = _stage(results,'train_model',quiet,
+                       lambda: train_model(X_bal,y_bal,X_val,y_val,'RF',search=train,budget_s=budget_s)[0],
+                       vectors=len(y_bal))
+        _stage(results,'evaluate_metrics',quiet,lambda: evaluate_metrics(model,X_val,y_val),vectors=len(y_val))
+
+    for r in results:
+        r['patients'] = n_patients
+
+    return results
+
+
+def import_time(module='scoring',repeats=5):
+    """
+    Time of importing a module in a new interpreter, as a short-lived scoring worker would, and the modules of
+    LAZY_MODULES it imports (there should be none for scoring).
+
+    Parameters
+    ----------
+    module: Optional[str]
+        module to import
+    repeats: Optional[int]
+        number of new interpreters, the fastest one counts
+
+    Returns
+    -------
+    seconds: float
+        import time of the fastest run
+    loaded: list[str]
+        modules of LAZY_MODULES that were imported
+    """
+    import os
+    import subprocess
+
+    code = ('import sys,time,json; t = time.perf_counter(); import {}; t = time.perf_counter() - t; '
+            'print(json.dumps([t,[m for m in {} if m in sys.modules]]))').format(module,LAZY_MODULES)
+    runs = [json.loads(subprocess.run([sys.executable,'-c',code],capture_output=True,text=True,check=True,
+                                      cwd=os.path.dirname(os.path.abspath(__file__))).stdout) for _ in range(repeats)]
+
+    return min(t for t,_ in runs),runs[0][1]
+
+
+def run_benchmark(sizes=(1000,10000,100000),out='benchmark.json',**kwargs):
+    """
+    Runs benchmark_size for every size, each in a new process so peak memory is measured per size, and writes the
+    results with the settings and machine to a JSON file for comparison with compare_benchmarks.
+
+    Returns
+    -------
+    results: pd.DataFrame
+        one row per size and stage
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    results = []
+    for n in sizes:
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            results += pool.submit(benchmark_size,n,**kwargs).result()
+
+    report = {'created':time.strftime('%Y-%m-%d %H:%M:%S'),
+              'machine':{'python':platform.python_version(),'platform':platform.platform(),'processor':platform.processor(),
+                         'numpy':np.__version__,'pandas':pd.__version__},
+              'settings':{'sizes':list(sizes),**kwargs},
+              'results':results}
+
+    if out is not None:
+        with open(out,'w') as f:
+            json.dump(report,f,indent=1,default=str)
+        print('benchmark written to',out,file=sys.stderr)
+
+    return pd.DataFrame(results)
+
+
+def compare_benchmarks(old,new,tolerance=0.2):
+    """
+    Compares two benchmark files from run_benchmark per size and stage.
+
+    Parameters
+    ----------
+    old, new: str
+        paths of the JSON files
+    tolerance: Optional[float]
+        relative increase of wall time or peak memory that is reported as regression
+
+    Returns
+    -------
+    comparison: pd.DataFrame
+        wall time and peak RSS of both runs, their ratio (new / old) and whether it is a regression
+    """
+    tables = []
+    for path in [old,new]:
+        with open(path) as f:
+            tables.append(pd.DataFrame(json.load(f)['results']).set_index(['patients','stage'])[['wall_s','peak_rss_mb']])
+
+    comparison = tables[0].join(tables[1],lsuffix='_old',rsuffix='_new',how='inner')
+    comparison['wall_ratio'] = comparison['wall_s_new']/comparison['wall_s_old']
+    comparison['rss_ratio'] = comparison['peak_rss_mb_new']/comparison['peak_rss_mb_old']
+    comparison['regression'] = (comparison['wall_ratio'] > 1 + tolerance) | (comparison['rss_ratio'] > 1 + tolerance)
+
+    return comparison
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on synthetic cohorts')
+    parser.add_argument('--sizes',type=int,nargs='+',default=[1000,10000,100000],help='numbers of patients')
+    parser.add_argument('--out',default='benchmark.json')
+    parser.add_argument('--train',default='halving',help="'grid', 'halving' or 'none'")
+    parser.add_argument('--budget-s',type=float,default=60,help='time budget of the halving search')
+    parser.add_argument('--stay-hours',type=float,default=120,help='mean length of stay of the synthetic patients')
+    parser.add_argument('--frequency',type=float,default=1.0,help='multiplier of the measurement frequency')
+    parser.add_argument('--compare',default=None,help='earlier benchmark file to compare with')
+    parser.add_argument('--import-budget',type=float,default=None,
+                        help='only check that scoring imports within this many seconds without LAZY_MODULES')
+    args = parser.parse_args()
+
+    if args.import_budget is not None:
+        seconds,loaded = import_time('scoring')
+        print('import scoring: {:.3f}s (budget {}s), lazy modules imported: {}'.format(seconds,args.import_budget,loaded or 'none'))
+        sys.exit(0 if seconds <= args.import_budget and not loaded else 1)
+
+    results = run_benchmark(args.sizes,args.out,train=None if args.train == 'none' else args.train,budget_s=args.budget_s,
+                            cohort={'stay_hours':args.stay_hours,'frequency':args.frequency})
+    print(results.to_string(index=False))
+
+    if args.compare is not None:
+        print(compare_benchmarks(args.compare,args.out).to_string())
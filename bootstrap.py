@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+
+
+def weighted_auc(scores,labels,weights):
+    """
+    Area under the ROC curve (ties count half) for many weightings of the same rows at once, with a single sort of
+    the scores. Row i counts weights[b,i] times in weighting b, so the rows of a multinomial weight matrix give the
+    AUC of bootstrap resamples. The AUC is the weighted Mann-Whitney statistic: for every positive, the cumulative
+    weight of the negatives below its score, looked up at positions that are the same for all weightings.
+
+    Parameters
+    ----------
+    scores: np.array
+        predicted probability per row [N]
+    labels: np.array
+        0/1 label per row [N]
+    weights: np.array
+        weight matrix [B x N]
+
+    Returns
+    -------
+    auc: np.array
+        AUC per weighting [B]
+    """
+    labels = np.asarray(labels).astype(bool)
+    weights = np.atleast_2d(weights)
+    pos,neg = np.flatnonzero(labels),np.flatnonzero(~labels)
+    neg = neg[np.argsort(scores[neg],kind='mergesort')]
+
+    # negatives with a lower and with a lower or equal score than every positive, found once in the sorted negatives
+    lo = np.searchsorted(scores[neg],scores[pos],side='left')
+    hi = np.searchsorted(scores[neg],scores[pos],side='right')
+
+    below = np.zeros((weights.shape[0],len(neg) + 1))
+    np.cumsum(weights[:,neg],axis=1,out=below[:,1:])
+    w_pos = weights[:,pos]
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+        return (w_pos*(below[:,lo] + below[:,hi])).sum(axis=1)/(2*w_pos.sum(axis=1)*below[:,-1])
+
+
+def bootstrap_weights(n,n_boot,rng):
+    """
+    Multinomial weight matrix [n_boot x n]: how often each of n rows is drawn in each of n_boot bootstrap resamples.
+    """
+    draws = rng.integers(0,n,(n_boot,n)) + n*np.arange(n_boot)[:,None]
+
+    return np.bincount(draws.ravel(),minlength=n_boot*n).reshape(n_boot,n).astype(float)
+
+
+def cluster_weights(codes,n_boot,rng):
+    """
+    Weight matrix [n_boot x n] of a cluster bootstrap: patients are drawn with replacement and every row gets the
+    number of draws of its patient, so the feature vectors of a patient are resampled together.
+
+    Parameters
+    ----------
+    codes: np.array
+        patient number (0 .. N patients - 1) per row, e.g. from pd.factorize
+    """
+    return bootstrap_weights(codes.max() + 1,n_boot,rng)[:,codes]
+
+
+def weighted_metrics(y,proba,weights,threshold=0.5):
+    """
+    AUC, sensitivity, specificity and precision for every weighting of the rows [B x N].
+
+    Returns
+    -------
+    metrics: np.array
+        [B x 4]
+    """
+    y = np.asarray(y).astype(bool)
+    predicted = proba >= threshold
+    weights = np.atleast_2d(weights)
+
+    # weighted confusion counts as matrix-vector products
+    tp = weights @ (predicted & y).astype(float)
+    fp = weights @ (predicted & ~y).astype(float)
+    pos = weights @ y.astype(float)
+    neg = weights.sum(axis=1) - pos
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+        return np.c_[weighted_auc(proba,y,weights),tp/pos,(neg - fp)/neg,tp/(tp + fp)]
+
+
+def bootstrap_ci(y,proba,groups=None,n_boot=1000,threshold=0.5,alpha=0.05,random_state=0,batch=None):
+    """
+    Bootstrap confidence intervals of the AUC, sensitivity, specificity and precision. Resamples are represented by
+    weight matrices and evaluated in batches of rows with weighted_metrics, so thousands of resamples take seconds.
+    With groups, patients are resampled instead of feature vectors (cluster bootstrap), which accounts for the
+    correlation between the feature vectors of one patient.
+
+    Parameters
+    ----------
+    y: np.array
+        label vector [N feature vectors x 1]
+    proba: np.array
+        predicted probability per feature vector
+    groups: Optional[np.array]
+        patient ID per feature vector, e.g. ids_val of Parchure. Row-level resampling if None.
+    n_boot: Optional[int]
+        number of resamples
+    threshold: Optional[float]
+        threshold for sensitivity, specificity and precision
+    alpha: Optional[float]
+        the intervals are the alpha/2 and 1-alpha/2 quantiles
+    batch: Optional[int]
+        number of resamples evaluated at once, by default such that a weight matrix has about 16M entries
+
+    Returns
+    -------
+    ci: pd.DataFrame
+        estimate, standard error, lower and upper bound per metric
+    """
+    rng = np.random.default_rng(random_state)
+    proba = np.asarray(proba,dtype=float)
+    n = len(proba)
+    batch = batch or max(1,2**24//max(n,1))
+    codes = None if groups is None else pd.factorize(np.asarray(groups))[0]
+
+    samples = []
+    for start in range(0,n_boot,batch):
+        size = min(batch,n_boot - start)
+        weights = bootstrap_weights(n,size,rng) if codes is None else cluster_weights(codes,size,rng)
+        samples.append(weighted_metrics(y,proba,weights,threshold))
+    samples = np.concatenate(samples)
+
+    return pd.DataFrame({'estimate':weighted_metrics(y,proba,np.ones(n),threshold)[0],
+                         'std':np.nanstd(samples,axis=0),
+                         'lower':np.nanquantile(samples,alpha/2,axis=0),
+                         'upper':np.nanquantile(samples,1 - alpha/2,axis=0)},
+                        index=['auc','sensitivity','specificity','precision'])
+
+
+def patient_level(y,proba,ids,how='max',times=None):
+    """
+    Aggregates feature vectors to one prediction per patient: a patient is positive if any of its feature vectors is,
+    and its risk is the maximum (how='max'), mean ('mean') or latest ('last') predicted probability. 'last' needs the
+    sample time per feature vector (times), as feature vectors are not in time order (see sampling_plan).
+
+    Returns
+    -------
+    y_patient: np.array
+    proba_patient: np.array
+    ids_patient: np.array
+    """
+    table = pd.DataFrame({'y':np.asarray(y),'proba':np.asarray(proba)})
+    ids = np.asarray(ids)
+    if how == 'last':
+        if times is None:
+            raise ValueError("how='last' needs the sample times")
+        order = np.argsort(np.asarray(times),kind='stable')
+        table,ids = table.iloc[order],ids[order]
+    table = table.groupby(ids,sort=True)
+    y_patient = table['y'].max()
+
+    return y_patient.values,table['proba'].agg(how).values,y_patient.index.values
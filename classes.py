@@ -1,9 +1,9 @@
 import pandas as pd
 import random
 import numpy as np
-import matplotlib.pyplot as plt
 
 from functions import *
+from instrument import instrumented
 
 class Parchure:
     def __init__(self,inputs,encoders,df):
@@ -15,57 +15,427 @@ class Parchure:
         self.df_demo_val = pd.DataFrame         # df with demograhics for validation set
         self.df_demo_test = pd.DataFrame        # df with demograhics for test set
         self.X_train = []                       # Matrix with feature vectors for training set
-        self.X_train_bal = []                   # Balanced matrix with feature vectors for training set
+        self.idx_train_bal = []                 # rows of X_train in the balanced training set
+        self.w_train = None                     # class-balancing sample weight per feature vector of the training set
+        self.balance_settings = {}              # undersampling, stratified, weights and random_state of Balance
         self.y_train = []                       # label vector for train set
         self.y_train_bal = []                   # balanced label vector for train set
+        self.ids_train_bal = []                 # patient ID per feature vector of the balanced training set
         self.X_val = []                         # Matrix with feature vectors for validation set
         self.y_val = []                         # label vector for validation set
         self.X_test = []                        # Matrix with feature vectors for test set
         self.y_test = []                        #label vector for test set
+        self.ids_train = []                     # patient ID per feature vector of the training set
+        self.ids_val = []                       # patient ID per feature vector of the validation set
+        self.ids_test = []                      # patient ID per feature vector of the test set
+        self.times_train = []                   # sample timestamp per feature vector of the training set
+        self.times_val = []                     # sample timestamp per feature vector of the validation set
+        self.times_test = []                    # sample timestamp per feature vector of the test set
+        self.patient_ids = []                   # patient ID per code, if ids_* hold int32 codes (compact)
+        self.layout = pd.DataFrame              # name, variable and lag of every column of X, see feature_layout
         self.features = []                      # array with names of variables   
+        self.events = None                      # event time per patient and label type, see event_index
+        self.imputer = None                     # imputation statistics of the train set
+        self.scaler_table = None                # mean and std per variable of the train set
+        self.split_settings = {}                # random_state, val_share, test_share and imputation of Prepare
+        self.window_settings = {}               # pred_window, gap, int_neg, int_pos, feature_window, label_type, sampling and kernels
         self.clf = None                         # model object
+        self.models = []                        # fitted models of Train_models, in the order of the leaderboard
+        self.leaderboard = None                 # validation AUC, train time and predict throughput per model
+        self.shap = {}                          # split -> (SHAP values, explained rows of X), see Explain
+        self.importance = None                  # SHAP importance per variable, summed over the lags
+        self.evaluation = None                  # Evaluation of the model on the validation set
        
 
 
-    def Prepare(self,random_state,val_share=0.2,test_share=0.2):
+    @instrumented('Parchure.Prepare',rows=lambda a,out: len(a['self'].df))
+    def Prepare(self,random_state,val_share=0.2,test_share=0.2,imputation='median'):
         
-        self.df_train,self.df_val,self.df_test, self.df_demo_train,self.df_demo_val,self.df_demo_test = df_preparer(self.df,self.features,
+        self.df_train,self.df_val,self.df_test, self.df_demo_train,self.df_demo_val,self.df_demo_test,self.scaler_table = df_preparer(self.df,self.features,
                                                                             val_share,test_share,random_state) 
         
+        self.imputer = Imputer(strategy=imputation).Fit(self.df_train,self.df_demo_train,self.features)
+        self.events = None
+        self.split_settings = {'random_state':random_state,'val_share':val_share,'test_share':test_share,'imputation':imputation}
+        
     
-    def Build_feature_vectors(self,pred_window,gap,int_neg,int_pos,feature_window,label_type='mortality'):
-       
-                   
-        print('TRAINING DATA')
-        self.X_train,self.y_train,imputation_train,feature_imputation,_ = prepare_feature_vectors(self.df_train, self.df_train, self.df_demo_train,self.df_demo_train,
-                                                                          self.ids_events,pred_window,gap,int_neg,int_pos,feature_window,self.features,
-                                                                        label_type=label_type)
-       
+    def Events(self,label_type='mortality'):
+        
+        # event times are added per label type on first use, so a label type whose columns are missing (e.g. ICU
+        # without DEPARTMENT) is never evaluated. From the split frames, which only keep the rows of self.features,
+        # like the data that is sampled from.
+        if self.events is None or label_type not in self.events.columns:
+            events = pd.concat([event_index(df,[label_type]) for df in [self.df_train,self.df_val,self.df_test]])
+            self.events = events if self.events is None else self.events.join(events)
+        
+        return self.events
+        
+    @instrumented('Parchure.Build_feature_vectors',
+                  vectors=lambda a,out: len(a['self'].y_train) + len(a['self'].y_val) + len(a['self'].y_test))
+    def Build_feature_vectors(self,pred_window,gap,int_neg,int_pos,feature_window,label_type='mortality',legacy=False,
+                              n_jobs=1,chunk_size=200,store_dir=None,data_version=None,compact=False,sampling='parchure',
+                              kernels=None):
+        
+        self.window_settings = {'pred_window':pred_window,'gap':gap,'int_neg':int_neg,'int_pos':int_pos,
+                                'feature_window':feature_window,'label_type':label_type,'sampling':sampling,'kernels':kernels}
+        self.layout = feature_layout(list(self.df_demo_train.columns[1:]),self.features,feature_window,kernels)
+        dtype = np.float32 if compact else np.float64
+        
+        # reuse the feature vectors of an earlier run with the same data and settings
+        if store_dir is not None:
+            import store
+            
+            if data_version is None:
+                data_version = store.data_version(self.df)
+            config = dict(data_version=data_version,pred_window=pred_window,gap=gap,int_neg=int_neg,int_pos=int_pos,
+                          feature_window=feature_window,features=self.features,label_type=label_type,compact=compact,
+                          sampling=sampling,**({'kernels':kernels} if kernels else {}),
+                          **self.split_settings)
+            key = store.feature_key(**config)
+            
+            arrays = store.load_features(store_dir,key)
+            if arrays is not None:
+                for name,a in arrays.items():
+                    setattr(self,name,a)
+                return
         
-        print('VALIDATION DATA')
-        self.X_val,self.y_val,imputation_val,_,self.val_pos = prepare_feature_vectors(self.df_val, self.df_train, self.df_demo_val,self.df_demo_train,
-                                                                        self.ids_events,pred_window,gap,int_neg,int_pos,feature_window,self.features,
-                                                                        label_type=label_type)
-        print('TEST DATA')
-        self.X_test,self.y_test,imputation_test,_,_ = prepare_feature_vectors(self.df_test, self.df_train, self.df_demo_test,self.df_demo_train,
-                                                                        self.ids_events,pred_window,gap,int_neg,int_pos,feature_window,self.features,
-                                                                        label_type=label_type)
+        events = self.Events(label_type)
+        splits = [('TRAINING DATA',self.df_train,self.df_demo_train),
+                  ('VALIDATION DATA',self.df_val,self.df_demo_val),
+                  ('TEST DATA',self.df_test,self.df_demo_test)]
+        
+        def build(name,df,df_demo,n_jobs):
+            print(name)
+            return prepare_feature_vectors(df, df_demo, self.imputer, pred_window,gap,int_neg,int_pos,feature_window,self.features,
+                                           label_type=label_type,legacy=legacy,n_jobs=n_jobs,chunk_size=chunk_size,return_plan=True,
+                                           dtype=dtype,sampling=sampling,events=events,kernels=kernels)
+        
+        if n_jobs == 1:
+            results = [build(name,df,df_demo,1) for name,df,df_demo in splits]
+        else:
+            # build the splits concurrently, the workers are divided over the splits by size
+            from concurrent.futures import ThreadPoolExecutor
+            import os
+            
+            n_jobs = os.cpu_count() if n_jobs < 1 else n_jobs
+            n_rows = sum(df.shape[0] for _,df,_ in splits)
+            
+            with ThreadPoolExecutor(max_workers=len(splits)) as pool:
+                futures = [pool.submit(build,name,df,df_demo,max(1,round(n_jobs*df.shape[0]/n_rows))) for name,df,df_demo in splits]
+                results = [f.result() for f in futures]
+        
+        for name,(X,y,plan) in zip(['train','val','test'],results):
+            setattr(self,'X_' + name,X)
+            setattr(self,'y_' + name,y)
+            setattr(self,'ids_' + name,plan['ID'].values)
+            setattr(self,'times_' + name,plan['TIME'].values)
+        
+        if compact:
+            # int32 patient codes (self.patient_ids[code] is the ID) and int64 epoch hours
+            codes,self.patient_ids = pd.factorize(np.concatenate([plan['ID'].values for _,_,plan in results]))
+            bounds = np.cumsum([len(plan) for _,_,plan in results])[:-1]
+            for name,c in zip(['train','val','test'],np.split(codes.astype(np.int32),bounds)):
+                setattr(self,'ids_' + name,c)
+                setattr(self,'times_' + name,getattr(self,'times_' + name).astype('datetime64[h]').astype(np.int64))
+        
+        if store_dir is not None:
+            arrays = {prefix + name:getattr(self,prefix + name) for name in ['train','val','test'] 
+                      for prefix in ['X_','y_','ids_','times_']}
+            if compact:
+                arrays['patient_ids'] = self.patient_ids
+            store.save_features(store_dir,key,arrays,config)
     
-    def Balance(self, undersampling = True):
+    @instrumented('Parchure.Balance',vectors=lambda a,out: len(a['self'].y_train))
+    def Balance(self, undersampling = True, stratified = False, weights = False, random_state = 0):
+        
+        # only row numbers (or weights) are stored, X_train is not copied
+        self.balance_settings = {'undersampling':undersampling,'stratified':stratified,'weights':weights,
+                                 'random_state':random_state}
+        if weights:
+            self.w_train = balance_weights(self.y_train)
+            return
         
-        self.X_train_bal,self.y_train_bal = balancer(self.X_train,self.y_train,undersampling = undersampling)        
+        self.w_train = None
+        self.idx_train_bal = balance_indices(self.y_train,undersampling,groups=self.ids_train if stratified else None,
+                                             random_state=random_state)
+        self.y_train_bal = np.asarray(self.y_train)[self.idx_train_bal]
+        self.ids_train_bal = np.asarray(self.ids_train)[self.idx_train_bal]
+        print('After balancing: \n n pos',int(sum(self.y_train_bal)),'n neg',int(len(self.y_train_bal)-sum(self.y_train_bal)))
         
-    def Train(self,model='RF',balance=True):
-        if balance:
+    @instrumented('Parchure.Train')
+    def Train(self,model='RF',balance=True,search='grid',budget_s=None,grouped=False):
+        if balance and self.w_train is not None:
             
-            self.clf,train_auc,self.explainer = train_model(self.X_train_bal,self.y_train_bal,self.X_test,self.y_test,model)
+            self.clf,train_auc,self.explainer = train_model(self.X_train,self.y_train,self.X_test,self.y_test,model,
+                                                            search=search,budget_s=budget_s,sample_weight=self.w_train,
+                                                            groups=self.ids_train if grouped else None)
+        elif balance and not self.balance_settings.get('undersampling',True):
+            
+            # oversampled rows as repeat counts, so X_train is not copied
+            self.clf,train_auc,self.explainer = train_model(self.X_train,self.y_train,self.X_test,self.y_test,model,
+                                                            search=search,budget_s=budget_s,
+                                                            sample_weight=np.bincount(self.idx_train_bal,minlength=len(self.y_train)),
+                                                            groups=self.ids_train if grouped else None)
+        elif balance:
+            
+            self.clf,train_auc,self.explainer = train_model(self.X_train[self.idx_train_bal],self.y_train_bal,self.X_test,
+                                                            self.y_test,model,search=search,budget_s=budget_s,
+                                                            groups=self.ids_train_bal if grouped else None)
         else:
-            self.clf,train_auc,self.explainer = train_model(self.X_train,self.y_train,self.X_test,self.y_test,model)
+            self.clf,train_auc,self.explainer = train_model(self.X_train,self.y_train,self.X_test,self.y_test,model,
+                                                            search=search,budget_s=budget_s,
+                                                            groups=self.ids_train if grouped else None)
         
         return train_auc
         
-    def Evaluate(self):
-        auc,tn, fp, fn, tp,precision,recall = evaluate_metrics(self.clf,self.X_val,self.y_val)
-        plot_roc_curve(self.clf, self.X_val, self.y_val)
-        plot_PR_curve(precision,recall)
-        return auc,tn, fp, fn, tp
+    def Train_models(self,specs=('RF','LR','HGB'),balance=True,n_jobs=-1):
+        
+        # fits the models concurrently on one shared copy of the (balanced) training set, the best one on the test set
+        # becomes self.clf, the validation set is left for Evaluate
+        from training import train_models
+        
+        indices,weights = None,None
+        if balance and self.w_train is not None:
+            weights = self.w_train
+        elif balance and not self.balance_settings.get('undersampling',True):
+            weights = np.bincount(self.idx_train_bal,minlength=len(self.y_train)) # oversampled rows as repeat counts
+        elif balance:
+            indices = self.idx_train_bal
+        self.leaderboard,self.models = train_models(self.X_train,self.y_train,self.X_test,self.y_test,specs,indices=indices,
+                                                    sample_weight=weights,n_jobs=n_jobs)
+        self.clf = self.models[0]
+        
+        return self.leaderboard
+        
+    @instrumented('Parchure.Explain')
+    def Explain(self,split='val',n_jobs=1,chunk_size=500,cache_dir=None,approximate=False,max_rows=None,time_budget_s=None):
+        
+        from explain import shap_values, variable_importance
+        
+        X = getattr(self,'X_' + split)
+        self.shap[split] = shap_values(self.clf,X,background=self.X_train,n_jobs=n_jobs,chunk_size=chunk_size,
+                                       cache_dir=cache_dir,approximate=approximate,max_rows=max_rows,
+                                       time_budget_s=time_budget_s)
+        self.importance = variable_importance(self.shap[split][0],self.layout)
+        
+        return self.importance
+        
+    @instrumented('Parchure.Evaluate',vectors=lambda a,out: len(a['self'].y_val))
+    def Evaluate(self,threshold=0.5):
+        
+        # the validation set is predicted once, metrics and plots come from self.evaluation
+        self.evaluation = evaluate(self.clf,self.X_val,self.y_val,self.ids_val,self.times_val)
+        self.evaluation.Report(threshold)
+        self.evaluation.PlotROC()
+        self.evaluation.PlotPR()
+        tn, fp, fn, tp = self.evaluation.Confusion(threshold)
+        return self.evaluation.AUC(),tn, fp, fn, tp
+
+    def Sweep(self,configs,clf=None,label_type='mortality',balance=True,n_jobs=1):
+        
+        from sweep import run_sweep
+        
+        return run_sweep(self,configs,clf=clf,label_type=label_type,balance=balance,n_jobs=n_jobs)
+        
+    def Save(self,path):
+        
+        save_model(path,{'clf':self.clf,'imputer':self.imputer,'scaler_table':self.scaler_table,'features':self.features,
+                         **self.window_settings})
+
+    def Export(self,directory):
+        
+        # Parquet files that other jobs can read column-selectively, see columnar.read_features and read_splits
+        import os
+        from columnar import write_features, write_splits
+        
+        os.makedirs(directory,exist_ok=True)
+        write_splits(os.path.join(directory,'splits.parquet'),{name:getattr(self,'df_' + name)['ID'].unique() 
+                                                               for name in ['train','val','test']})
+        for name in ['train','val','test']:
+            ids,times = getattr(self,'ids_' + name),getattr(self,'times_' + name)
+            if len(self.patient_ids): # compact: int32 codes and epoch hours
+                ids,times = np.asarray(self.patient_ids)[ids],np.asarray(times).astype('datetime64[h]')
+            write_features(os.path.join(directory,'features_' + name + '.parquet'),getattr(self,'X_' + name),
+                           getattr(self,'y_' + name),ids,times,self.layout)
+
+
+class Imputer:
+    """
+    Imputation statistics, computed once on the train set.
+
+    Parameters
+    ----------
+    strategy: Optional[str]
+        'median', 'mean' or 'last'. With 'last', a missing variable is imputed with the most recent value of that 
+        variable in the train set. Demographics are imputed with the median for 'last'.
+    """
+    def __init__(self,strategy='median'):
+        self.strategy = strategy                # imputation strategy
+        self.values = pd.Series(dtype=float)    # imputed value per variable
+        self.demo = pd.Series(dtype=float)      # imputed value per demographic
+        
+    def Fit(self,df_train,df_demo_train,variables):
+        
+        df_train = df_train[df_train['VARIABLE'].isin(variables)]
+        df_demo_train = df_demo_train.dropna().iloc[:,1:]
+        
+        if self.strategy == 'median':
+            self.values = df_train.groupby('VARIABLE')['VALUE'].median()
+            self.demo = df_demo_train.median()
+        elif self.strategy == 'mean':
+            self.values = df_train.groupby('VARIABLE')['VALUE'].mean()
+            self.demo = df_demo_train.mean()
+        elif self.strategy == 'last':
+            self.values = df_train.sort_values('TIME',kind='mergesort').groupby('VARIABLE')['VALUE'].last()
+            self.demo = df_demo_train.median()
+        else:
+            raise ValueError('unknown imputation strategy: ' + str(self.strategy))
+        
+        self.values = self.values.reindex(variables)
+        
+        missing = self.values.index[self.values.isnull()]
+        if len(missing) > 0:
+            print('no imputation value for:',list(missing))
+        
+        return self
+
+
+class IncrementalFeatures:
+    """
+    Keeps the last n values of every variable of every patient, so feature vectors can be updated with only the new
+    measurements instead of rebuilding them from the whole cohort. The feature vectors have the same layout as 
+    create_feature_window with all data of a patient until now.
+
+    Parameters
+    ----------
+    imputer: Imputer
+        imputation statistics of the train set
+    features: np.array[str]
+        Array of strings representing the names of the variables to be included in the model.
+    feature_window: int
+        Number of most recent assessments to be included in feature vector
+    scaler_table: Optional[pd.DataFrame]
+        If given, new measurements and demographics are normalized with this table, see fit_scaler_table.
+    demographics: Optional[list[str]]
+        demographic columns, in the order of the feature vector
+    """
+    def __init__(self,imputer,features,feature_window,scaler_table=None,demographics=['AGE','BMI']):
+        self.imputer = imputer                          # imputation statistics of the train set
+        self.features = list(features)                  # array with names of variables
+        self.n = feature_window                         # number of values per variable
+        self.scaler_table = scaler_table                # normalization of new data
+        self.demo_cols = demographics                   # demographic columns
+        self.patients = {}                              # ID -> row in the buffers
+        self.ids = []                                   # ID per row in the buffers
+        self.variables = pd.Index(self.features)        # position of every variable
+        self.demo = np.empty((0,len(demographics)))     # demographics per patient
+        self.values = np.empty((0,len(features),self.n))            # last n values, oldest first
+        self.times = np.empty((0,len(features),self.n),dtype='int64') # time of the last n values
+        self.count = np.empty((0,len(features)),dtype=int)          # number of buffered values
+        # the buffers have room for more patients than len(self.ids), their capacity doubles when they are full
+    
+    def _reserve(self,size):
+        
+        capacity = self.count.shape[0]
+        if size <= capacity:
+            return
+        capacity = max(size,2*capacity,16)
+        for name in ['demo','values','times','count']:
+            old = getattr(self,name)
+            new = np.zeros((capacity,) + old.shape[1:],dtype=old.dtype)
+            new[:old.shape[0]] = old
+            setattr(self,name,new)
+    
+    def _add_patients(self,df):
+        
+        first = df.drop_duplicates('ID')
+        first = first[[idx not in self.patients for idx in first['ID']]]
+        if first.shape[0] == 0:
+            return
+        
+        rows = np.arange(len(self.ids),len(self.ids) + first.shape[0])
+        for idx in first['ID']:
+            self.patients[idx] = len(self.ids)
+            self.ids.append(idx)
+        
+        demo = first[['ID'] + self.demo_cols]
+        if self.scaler_table is not None:
+            demo = normalize_demo(demo,self.scaler_table,self.demo_cols)
+        
+        self._reserve(len(self.ids))
+        self.demo[rows] = demo[self.demo_cols].values.astype(float)
+        
+    @instrumented('IncrementalFeatures.Update',rows=lambda a,out: len(a['df_new']),vectors=lambda a,out: len(out[0]))
+    def Update(self,df_new):
+        """
+        Adds new raw measurements (same columns as the raw df) and returns the feature vectors of the patients that 
+        have new data. Measurements may arrive out of order, they are placed by time.
+
+        Returns
+        -------
+        ids: np.array
+            patient IDs of the changed feature vectors
+        X: matrix [N changed patients x N variables]
+        """
+        self._add_patients(df_new)
+        
+        if self.scaler_table is not None:
+            df_new = normalize(df_new,self.scaler_table)
+        df_new = df_new[df_new['VARIABLE'].isin(self.features)]
+        
+        # buffer rows of the patients in the update, only the update is searched
+        n_var,n = len(self.features),self.n
+        new_ids = pd.Index(pd.unique(df_new['ID']))
+        p = np.array([self.patients[idx] for idx in new_ids],dtype=int)[new_ids.get_indexer(df_new['ID'])]
+        group = p*n_var + self.variables.get_indexer(df_new['VARIABLE'])
+        
+        # buffered values of the (patient, variable) pairs that have new data
+        groups = np.unique(group)
+        c = self.count.ravel()[groups]
+        old_group = np.repeat(groups,c)
+        old_slot = np.arange(len(old_group)) - np.repeat(np.cumsum(c) - c,c)
+        old_values = self.values.reshape(-1,n)[old_group,old_slot]
+        old_times = self.times.reshape(-1,n)[old_group,old_slot]
+        
+        # merge with the new values by time (buffered values first on ties) and keep the last n of every pair
+        g = np.concatenate((old_group,group))
+        t = np.concatenate((old_times,df_new['TIME'].values.astype('datetime64[ns]').view('int64')))
+        v = np.concatenate((old_values,df_new['VALUE'].values.astype(float)))
+        order = np.lexsort((np.arange(len(g)),t,g))
+        g,t,v = g[order],t[order],v[order]
+        
+        end = np.searchsorted(g,g,side='right')
+        start = np.searchsorted(g,g,side='left')
+        from_end = end - 1 - np.arange(len(g))
+        keep = from_end < n
+        size = np.minimum(end - start,n)
+        slot = (size - 1 - from_end)[keep]
+        
+        self.values.reshape(-1,n)[g[keep],slot] = v[keep]
+        self.times.reshape(-1,n)[g[keep],slot] = t[keep]
+        self.count.reshape(-1)[groups] = np.minimum(np.bincount(np.searchsorted(groups,g),minlength=len(groups)),n)
+        
+        changed = np.unique(p)
+        
+        return np.array([self.ids[row] for row in changed],dtype=object),self.Vectors(changed)
+    
+    def Vectors(self,rows=None):
+        """
+        Feature vectors of the patients in the given rows of the buffers (all patients if None).
+
+        Returns
+        -------
+        X: matrix [N patients x N variables]
+        """
+        if rows is None:
+            rows = np.arange(len(self.ids))
+        
+        n = self.n
+        c = self.count[rows]
+        lag = np.minimum(np.arange(n)[None,None,:],np.maximum(c - 1,0)[:,:,None])
+        window = np.take_along_axis(self.values[rows],lag,axis=2)
+        window = np.where((c == 0)[:,:,None],self.imputer.values.reindex(self.features).values[None,:,None],window)
+        
+        demo = pd.DataFrame(self.demo[rows],columns=self.demo_cols).fillna(self.imputer.demo[self.demo_cols]).values
+        
+        return np.concatenate((demo,window.reshape(len(rows),-1)),axis=1)
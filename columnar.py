@@ -0,0 +1,193 @@
+import json
+import numpy as np
+import pandas as pd
+
+
+def write_measurements(df,path,row_group_size=100000):
+    """
+    Writes the raw long df (columns ['ID','BMI','AGE','DEST','DEPARTMENT','TIME','VARIABLE','VALUE']) to a Parquet
+    file, sorted by ID and TIME. As the rows of a patient are together, the row groups that hold none of the requested
+    patients are skipped by read_measurements using the min/max statistics of ID.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        raw df
+    path: str
+        Parquet file
+    row_group_size: Optional[int]
+        rows per row group, smaller groups make the ID filter more selective
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    df = df.sort_values(['ID','TIME'],kind='mergesort')
+    table = pa.Table.from_pandas(df,preserve_index=False)
+    pq.write_table(table,path,row_group_size=row_group_size)
+
+    print('measurements written to',path)
+
+
+def read_measurements(path,variables=None,ids=None,columns=None):
+    """
+    Reads raw measurements from a Parquet file or a directory of Parquet files (e.g. from write_measurements or an
+    export of the hospital data). The filters on VARIABLE and ID are pushed down to Arrow, so only the row groups of
+    the requested patients are read and rows of other variables never become pandas rows.
+
+    Parameters
+    ----------
+    path: str
+        Parquet file or directory
+    variables: Optional[list[str]]
+        variables to read, e.g. the features of the model. All variables if None.
+    ids: Optional[np.array]
+        patients to read, e.g. the IDs of one split from read_splits. All patients if None.
+    columns: Optional[list[str]]
+        columns to read, all columns if None
+
+    Returns
+    -------
+    df: pd.DataFrame
+        raw df, with TIME as datetime64
+    """
+    import pyarrow.dataset as ds
+
+    condition = None
+    for name,values in [('VARIABLE',variables),('ID',ids)]:
+        if values is not None:
+            expression = ds.field(name).isin(list(values))
+            condition = expression if condition is None else condition & expression
+
+    table = ds.dataset(path,format='parquet').to_table(columns=columns,filter=condition)
+    df = table.to_pandas()
+    if 'TIME' in df.columns and not pd.api.types.is_datetime64_any_dtype(df['TIME']):
+        df['TIME'] = pd.to_datetime(df['TIME'])
+
+    print('read',df.shape[0],'measurements of',df['ID'].nunique() if 'ID' in df.columns else '?','patients from',path)
+
+    return df
+
+
+def write_splits(path,splits):
+    """
+    Writes the split assignment of the patients to a Parquet file with the columns ['ID','SPLIT'].
+
+    Parameters
+    ----------
+    path: str
+        Parquet file
+    splits: dict
+        split name -> patient IDs, e.g. {'train':ids_train,'val':ids_val,'test':ids_test}
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    ids = [pd.unique(np.asarray(v)) for v in splits.values()]
+    table = pa.table({'ID':np.concatenate(ids) if ids else [],
+                      'SPLIT':np.repeat(list(splits),[len(v) for v in ids])})
+    pq.write_table(table,path)
+
+
+def read_splits(path,split=None):
+    """
+    Reads a split assignment written by write_splits.
+
+    Returns
+    -------
+    splits: pd.DataFrame or np.array
+        columns ['ID','SPLIT'], or the patient IDs of split if it is given
+    """
+    import pyarrow.parquet as pq
+
+    filters = None if split is None else [('SPLIT','=',split)]
+    splits = pq.read_table(path,filters=filters).to_pandas()
+
+    return splits if split is None else splits['ID'].values
+
+
+def write_features(path,X,y=None,ids=None,times=None,layout=None,row_group_size=100000):
+    """
+    Writes a feature matrix to a Parquet file with one column per feature, so other jobs can read some of the
+    features without the rest (see read_features). The dtype of X (e.g. float32) is kept.
+
+    Parameters
+    ----------
+    path: str
+        Parquet file
+    X: matrix [N feature vectors x N features]
+    y: Optional[np.array]
+        label per feature vector, column 'LABEL'
+    ids: Optional[np.array]
+        patient ID per feature vector, column 'ID'
+    times: Optional[np.array]
+        sample timestamp per feature vector, column 'TIME'
+    layout: Optional[pd.DataFrame]
+        see feature_layout, gives the column names and is stored in the metadata of the file.
+        Columns 'f0', 'f1', ... if None.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    X = np.asfortranarray(X) # contiguous columns
+    names = list(layout['name']) if layout is not None else ['f{}'.format(j) for j in range(X.shape[1])]
+
+    columns = {}
+    for name,values in [('ID',ids),('TIME',times),('LABEL',y)]:
+        if values is not None:
+            values = np.asarray(values)
+            columns[name] = pa.array(values.astype('datetime64[ns]') if values.dtype.kind == 'M' else values)
+    for j,name in enumerate(names):
+        columns[name] = pa.array(X[:,j])
+
+    table = pa.table(columns)
+    if layout is not None:
+        table = table.replace_schema_metadata({'layout':json.dumps(layout.to_dict(orient='list'))})
+    pq.write_table(table,path,row_group_size=row_group_size)
+
+    print('features written to',path)
+
+
+def read_features(path,variables=None,columns=None):
+    """
+    Reads a feature matrix written by write_features. Only the requested columns are read from disk.
+
+    Parameters
+    ----------
+    path: str
+        Parquet file
+    variables: Optional[list[str]]
+        read only the features of these variables (and the demographics), needs the layout in the file
+    columns: Optional[list[str]]
+        read only these feature columns. All features if both variables and columns are None.
+
+    Returns
+    -------
+    X: matrix [N feature vectors x N features read]
+    y: np.array or None
+    ids: np.array or None
+    times: np.array or None
+    layout: pd.DataFrame or None
+        layout of the columns of X
+    """
+    import pyarrow.parquet as pq
+
+    schema = pq.read_schema(path)
+    meta = schema.metadata or {}
+    layout = pd.DataFrame(json.loads(meta[b'layout'])) if b'layout' in meta else None
+
+    extra = [c for c in ['ID','TIME','LABEL'] if c in schema.names]
+    if columns is None:
+        columns = [c for c in schema.names if c not in extra]
+    if variables is not None:
+        if layout is None:
+            raise ValueError('selecting variables needs the layout, see write_features')
+        keep = (layout['variable'] == layout['name']) | layout['variable'].isin(variables) # demographics and variables
+        columns = [c for c in columns if c in set(layout.loc[keep,'name'])]
+    if layout is not None:
+        layout = layout.set_index('name').loc[columns].reset_index()
+
+    table = pq.read_table(path,columns=extra + columns)
+    X = np.column_stack([table.column(c).to_numpy() for c in columns]) if columns else np.empty((table.num_rows,0))
+    y,ids,times = [table.column(c).to_numpy() if c in extra else None for c in ['LABEL','ID','TIME']]
+
+    return X,y,ids,times,layout
@@ -0,0 +1,182 @@
+import numpy as np
+import pandas as pd
+
+from bootstrap import bootstrap_ci, patient_level
+
+
+class Evaluation:
+    """
+    Performance of a model on one set, computed from a single pass of predictions. The scores are sorted once; the
+    AUC, confusion matrix at any threshold, ROC and PR curves, calibration and bootstrap intervals are all derived
+    from the cached scores, so the model is never run again. See evaluate to build it from a model.
+
+    A feature vector is predicted positive if its score is >= the threshold.
+
+    Parameters
+    ----------
+    y: np.array
+        label vector [N feature vectors x 1]
+    proba: np.array
+        predicted probability of the outcome per feature vector
+    ids: Optional[np.array]
+        patient ID per feature vector
+    times: Optional[np.array]
+        sample time per feature vector, needed for PatientLevel('last')
+    """
+    def __init__(self,y,proba,ids=None,times=None):
+        self.y = np.asarray(y).astype(int)          # labels
+        self.proba = np.asarray(proba,dtype=float)  # predicted probabilities
+        self.ids = ids                              # patient ID per feature vector
+        self.times = times                          # sample time per feature vector
+        self.n_pos = int(self.y.sum())              # number of positives
+        self.n_neg = len(self.y) - self.n_pos       # number of negatives
+
+        order = np.argsort(-self.proba,kind='mergesort')
+        self.scores = self.proba[order]                         # scores, decreasing
+        self.tp = np.cumsum(self.y[order])                      # true positives if the first k+1 scores are positive
+        self.fp = np.arange(1,len(order) + 1) - self.tp         # false positives idem
+        self.last = np.r_[np.diff(self.scores) != 0,True]       # last position of every distinct score
+
+    def Confusion(self,threshold=0.5):
+        """
+        Confusion counts at one or more thresholds.
+
+        Returns
+        -------
+        tn, fp, fn, tp: int or np.array
+        """
+        k = np.searchsorted(-self.scores,-np.asarray(threshold,dtype=float),side='right') # number of scores >= threshold
+        tp = np.where(k > 0,self.tp[np.maximum(k - 1,0)],0)
+        fp = np.where(k > 0,self.fp[np.maximum(k - 1,0)],0)
+        if np.ndim(threshold) == 0:
+            tp,fp = int(tp),int(fp)
+
+        return self.n_neg - fp,fp,self.n_pos - tp,tp
+
+    def ROC(self):
+        """
+        Returns
+        -------
+        fpr, tpr, thresholds: np.array
+            ROC curve, from (0,0) to (1,1)
+        """
+        fpr = np.r_[0,self.fp[self.last]]/max(self.n_neg,1)
+        tpr = np.r_[0,self.tp[self.last]]/max(self.n_pos,1)
+
+        return fpr,tpr,np.r_[np.inf,self.scores[self.last]]
+
+    def AUC(self):
+
+        fpr,tpr,_ = self.ROC()
+
+        return float(np.sum(np.diff(fpr)*(tpr[1:] + tpr[:-1]))/2)
+
+    def PR(self):
+        """
+        Returns
+        -------
+        precision, recall, thresholds: np.array
+            precision-recall curve for decreasing thresholds
+        """
+        tp,fp = self.tp[self.last],self.fp[self.last]
+
+        return tp/(tp + fp),tp/max(self.n_pos,1),self.scores[self.last]
+
+    def Calibration(self,n_bins=10):
+        """
+        Mean predicted probability and observed fraction of positives per bin of equal width.
+
+        Returns
+        -------
+        calibration: pd.DataFrame
+        """
+        bins = np.minimum((self.proba*n_bins).astype(int),n_bins - 1)
+        table = pd.DataFrame({'bin':bins,'predicted':self.proba,'observed':self.y}).groupby('bin')
+        calibration = table.mean()
+        calibration['count'] = table.size()
+
+        return calibration
+
+    def Bootstrap(self,n_boot=1000,threshold=0.5,alpha=0.05,cluster=False,random_state=0,batch=None):
+        """
+        Bootstrap confidence intervals of the AUC, sensitivity, specificity and precision, see bootstrap_ci.
+        With cluster=True, patients (self.ids) are resampled instead of feature vectors.
+
+        Returns
+        -------
+        ci: pd.DataFrame
+            estimate, standard error, lower and upper bound per metric
+        """
+        if cluster and self.ids is None:
+            raise ValueError('cluster bootstrap needs the patient IDs')
+
+        return bootstrap_ci(self.y,self.proba,groups=self.ids if cluster else None,n_boot=n_boot,threshold=threshold,
+                            alpha=alpha,random_state=random_state,batch=batch)
+
+    def PatientLevel(self,how='max'):
+        """
+        Evaluation with one prediction per patient, see patient_level.
+
+        Returns
+        -------
+        evaluation: Evaluation
+        """
+        y,proba,ids = patient_level(self.y,self.proba,self.ids,how,self.times)
+
+        return Evaluation(y,proba,ids)
+
+    def Report(self,threshold=0.5):
+
+        tn,fp,fn,tp = self.Confusion(threshold)
+
+        print('Model Performance:',self.AUC())
+        print('TN:',tn,'FP:',fp,'FN:',fn,'TP:',tp)
+        print('sens:',np.round(tp/(tp+fn),2),'spec:',np.round(tn/(tn+fp),2))
+        print('Recall:',np.round(tp/(tp+fn),2),'Pecision:',np.round(tp/(tp+fp),2) if tp + fp > 0 else np.nan)
+
+    def PlotROC(self,path='ROC_curve'):
+        import matplotlib.pyplot as plt
+
+        fpr,tpr,_ = self.ROC()
+        fig = plt.figure()
+        plt.plot(fpr,tpr,label='AUC = {:.3f}'.format(self.AUC()))
+        plt.plot([0,1],[0,1],'k--')
+        plt.xlabel('False Positive Rate')
+        plt.ylabel('True Positive Rate')
+        plt.legend(loc='lower right')
+        plt.savefig(path)
+        plt.close(fig)
+
+    def PlotPR(self,path='PR_curve'):
+        import matplotlib.pyplot as plt
+
+        precision,recall,_ = self.PR()
+        fig = plt.figure()
+        plt.plot(precision,recall)
+        plt.xlabel('Precision')
+        plt.ylabel('Recall')
+        plt.savefig(path)
+        plt.close(fig)
+
+    def PlotCalibration(self,n_bins=10,path='calibration_curve'):
+        import matplotlib.pyplot as plt
+
+        calibration = self.Calibration(n_bins)
+        fig = plt.figure()
+        plt.plot(calibration['predicted'],calibration['observed'],'o-')
+        plt.plot([0,1],[0,1],'k--')
+        plt.xlabel('Predicted probability')
+        plt.ylabel('Observed fraction')
+        plt.savefig(path)
+        plt.close(fig)
+
+
+def evaluate(model,X,y,ids=None,times=None):
+    """
+    Predicts X once and returns the Evaluation of the predictions.
+
+    Returns
+    -------
+    evaluation: Evaluation
+    """
+    return Evaluation(y,model.predict_proba(X)[:,1],ids,times)
@@ -0,0 +1,234 @@
+import os
+import time
+import pickle
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+def model_hash(clf):
+    """
+    Hash of a fitted model, to be used in the key of the SHAP cache.
+
+    Returns
+    -------
+    key: str
+    """
+    return hashlib.sha1(pickle.dumps(clf)).hexdigest()[:16]
+
+
+def matrix_hash(X):
+    """
+    Hash of the content, shape and dtype of a feature matrix.
+
+    Returns
+    -------
+    key: str
+    """
+    X = np.ascontiguousarray(X)
+    h = hashlib.sha1(str((X.shape,X.dtype.str)).encode())
+    h.update(memoryview(X.reshape(-1)).cast('B'))
+
+    return h.hexdigest()[:16]
+
+
+def _background_sample(background,n_background=100,random_state=0):
+    # random subsample of n_background rows of the background data, in their original order
+    if background is not None and len(background) > n_background:
+        rows = np.random.default_rng(random_state).choice(len(background),n_background,replace=False)
+        background = background[np.sort(rows)]
+
+    return background
+
+
+def make_explainer(clf,background=None,n_background=100,random_state=0):
+    """
+    SHAP explainer for clf: TreeExplainer for tree ensembles, LinearExplainer for linear models and KernelExplainer
+    otherwise. Linear and kernel explainers need background data, of which a random subsample of n_background rows
+    is used.
+
+    Returns
+    -------
+    explainer: object
+    """
+    import shap
+
+    background = _background_sample(background,n_background,random_state)
+
+    try:
+        return shap.TreeExplainer(clf)
+    except Exception:
+        if background is None:
+            raise ValueError('background data is needed to explain ' + type(clf).__name__)
+
+    if hasattr(clf,'coef_'):
+        return shap.LinearExplainer(clf,background)
+
+    return shap.KernelExplainer(lambda X: clf.predict_proba(X)[:,1],background)
+
+
+def _positive_class(values):
+    # SHAP values of the positive class, for the output formats of the different shap versions and explainers
+    if isinstance(values,list):
+        values = values[1]
+    values = np.asarray(values)
+    if values.ndim == 3:
+        values = values[:,:,1]
+
+    return values
+
+
+def _explain_chunk(explainer,X,approximate):
+
+    if approximate and type(explainer).__name__ == 'TreeExplainer':
+        return _positive_class(explainer.shap_values(X,approximate=True,check_additivity=False))
+    if type(explainer).__name__ == 'TreeExplainer':
+        return _positive_class(explainer.shap_values(X,check_additivity=False))
+
+    return _positive_class(explainer.shap_values(X))
+
+
+_explain_worker = {} # explainer of a worker process of shap_values
+
+def _init_explain_worker(clf,background,approximate,random_state=0):
+
+    _explain_worker.update(explainer=make_explainer(clf,background,random_state=random_state),approximate=approximate)
+
+
+def _explain_worker_chunk(X):
+
+    return _explain_chunk(_explain_worker['explainer'],X,_explain_worker['approximate'])
+
+
+def shap_values(clf,X,background=None,n_jobs=1,chunk_size=500,cache_dir=None,approximate=False,max_rows=None,
+                time_budget_s=None,random_state=0):
+    """
+    SHAP values of the positive class, computed in chunks of rows that are explained in parallel processes.
+    Results are cached in cache_dir, keyed by the hash of the model (model_hash), of X (matrix_hash) and the settings,
+    so explaining the same model on the same matrix again only loads a file. For models other than tree ensembles the
+    key also holds the hash of the background subsample, as their SHAP values depend on it.
+
+    For large cohorts, max_rows explains a random subsample of the rows, approximate uses the Saabas approximation of
+    tree SHAP values (much faster, less exact), and time_budget_s stops when the time is used: the chunks are in
+    random order, so the rows explained so far are a random subsample. Results cut off by the time budget are not
+    cached.
+
+    Parameters
+    ----------
+    clf: object
+        fitted sklearn classifier
+    X: np.array
+        featurematrix [N feature vectors x N variables]
+    background: Optional[np.array]
+        background data for models other than tree ensembles, e.g. X_train, see make_explainer
+    n_jobs: Optional[int]
+        number of worker processes, -1 for all cores
+    chunk_size: Optional[int]
+        number of rows per chunk
+    cache_dir: Optional[str]
+        directory of the cache, no caching if None
+    approximate: Optional[bool]
+        if True, use approximate tree SHAP values
+    max_rows: Optional[int]
+        explain at most max_rows random rows of X
+    time_budget_s: Optional[float]
+        time budget in seconds, no limit if None
+
+    Returns
+    -------
+    values: np.array
+        SHAP values [N explained rows x N variables]
+    rows: np.array
+        rows of X that were explained, sorted
+    """
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    print('shap_values triggered')
+    start = time.perf_counter()
+
+    explainer = None
+    if cache_dir is not None:
+        import shap
+
+        explainer = make_explainer(clf,background,random_state=random_state)
+        key = '{}_{}_{}_{}_{}'.format(model_hash(clf),matrix_hash(X),int(approximate),max_rows,random_state)
+        if not isinstance(explainer,shap.TreeExplainer):
+            key += '_' + matrix_hash(_background_sample(background,random_state=random_state))
+        path = os.path.join(cache_dir,key + '.npz')
+        if os.path.exists(path):
+            print('SHAP values loaded from',path)
+            cached = np.load(path)
+            return cached['values'],cached['rows']
+
+    rows = np.random.default_rng(random_state).permutation(len(X))
+    if max_rows is not None:
+        rows = rows[:max_rows]
+    chunks = [np.sort(rows[i:i + chunk_size]) for i in range(0,len(rows),chunk_size)]
+
+    def out_of_time():
+        return time_budget_s is not None and time.perf_counter() - start > time_budget_s
+
+    done = {}
+    if n_jobs == 1:
+        explainer = make_explainer(clf,background,random_state=random_state) if explainer is None else explainer
+        for k,r in enumerate(chunks):
+            if out_of_time():
+                break
+            done[k] = _explain_chunk(explainer,X[r],approximate)
+    else:
+        n_jobs = os.cpu_count() if n_jobs < 1 else n_jobs
+        pool = ProcessPoolExecutor(max_workers=n_jobs,initializer=_init_explain_worker,initargs=(clf,background,approximate,random_state))
+        futures = {pool.submit(_explain_worker_chunk,X[r]):k for k,r in enumerate(chunks)}
+        pending = set(futures)
+        while pending and not out_of_time():
+            timeout = None if time_budget_s is None else max(0,time_budget_s - (time.perf_counter() - start))
+            finished,pending = wait(pending,timeout=timeout,return_when=FIRST_COMPLETED)
+            for f in finished:
+                done[futures[f]] = f.result()
+        pool.shutdown(wait=False,cancel_futures=True)
+
+    complete = len(done) == len(chunks)
+    if not complete:
+        print('time budget used:',len(done),'of',len(chunks),'chunks explained')
+
+    explained = [k for k in range(len(chunks)) if k in done]
+    rows = np.concatenate([chunks[k] for k in explained]) if explained else np.array([],dtype=int)
+    values = np.concatenate([done[k] for k in explained]) if explained else np.empty((0,X.shape[1]))
+    order = np.argsort(rows,kind='mergesort')
+    rows,values = rows[order],values[order]
+
+    if cache_dir is not None and complete:
+        os.makedirs(cache_dir,exist_ok=True)
+        np.savez(path,values=values,rows=rows)
+
+    print('{} rows explained in {:.1f}s'.format(len(rows),time.perf_counter() - start))
+
+    return values,rows
+
+
+def variable_importance(values,layout):
+    """
+    Mean absolute SHAP value per column, summed over the lag and summary columns of every variable.
+
+    Parameters
+    ----------
+    values: np.array
+        SHAP values [N feature vectors x N variables], see shap_values
+    layout: pd.DataFrame
+        column layout of the feature matrix, see feature_layout
+
+    Returns
+    -------
+    importance: pd.DataFrame
+        per variable: importance (sum over lags and summaries) and the importance per lag and summary, sorted by
+        importance
+    """
+    per_column = pd.Series(np.abs(values).mean(axis=0),index=layout.index)
+    columns = ['lag{}'.format(lag) if lag >= 0 else 'static' for lag in layout['lag']]
+    if 'summary' in layout.columns:
+        columns = [c if pd.isna(s) else s for c,s in zip(columns,layout['summary'])]
+    table = pd.DataFrame({'variable':layout['variable'].values,'column':columns,'value':per_column.values})
+    importance = table.pivot_table(index='variable',columns='column',values='value',aggfunc='sum',sort=False)
+    importance.insert(0,'importance',importance.sum(axis=1))
+
+    return importance.sort_values('importance',ascending=False)
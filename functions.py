@@ -3,9 +3,13 @@ import numpy as np
 import pandas as pd
 import datetime
 import math
-import matplotlib.pyplot as plt
 import sys
+import time
 
+from evaluation import Evaluation, evaluate
+from instrument import instrumented, observe
+
+@instrumented('df_preparer',rows=lambda a,out: len(a['df']))
 def df_preparer(df,variables, val_share=0.25,test_share=0.2,random_state=0,norm=True):
     
     print('df_preparer triggered')
@@ -34,43 +38,28 @@ def df_preparer(df,variables, val_share=0.25,test_share=0.2,random_state=0,norm=
     -------
     df_train,df_val,df_test,df_demo_train,df_demo_val,df_demo_test
     type : pd.DataFrame
+        The dfs are sorted by ID, the demographics dfs are indexed by ID.
+    scaler_table: pd.DataFrame
+        mean and std per variable of the training set, see fit_scaler_table. None if norm is False.
     """
     
-    from sklearn.model_selection import train_test_split
-    from sklearn.preprocessing import StandardScaler
-    
     # create df with Demographics data (BMI and AGE) -- >  df_demo
     
-    ids = np.unique(df['ID']) # Unique IDs in raw dataset
-    bmi = []
-    age =[]
-    for i in ids:
-        bmi.append(df[df['ID']==i].reset_index()['BMI'][0])
-        age.append(df[df['ID']==i].reset_index()['AGE'][0])
-    df_demo = pd.DataFrame()
-    df_demo['ID'] = ids
-    df_demo['BMI'] = bmi
-    df_demo['AGE'] = age
+    df,index = patient_index(df) # sort by ID once
+    ids = np.array(list(index)) # Unique IDs in raw dataset
+    df_demo = demographics(df,index)
     
     
-    # Split raw df in training and validation set on patient level:
-    ids_train,ids_val = train_test_split(ids, test_size=val_share,random_state=random_state)
+    # Split raw df in training, validation and test set on patient level:
+    ids_train,ids_val,ids_test = split_ids(ids,val_share,test_share,random_state)
     
-    df_train_full = df[df['ID'].isin(ids_train)]
+    df_train = df[df['ID'].isin(ids_train)]
     df_val = df[df['ID'].isin(ids_val)]
-    
-    df_demo_train_full = df_demo[df_demo['ID'].isin(ids_train)]
-    df_demo_val = df_demo[df_demo['ID'].isin(ids_val)]
-
-    #split training set in training and testing set
-    ids = np.unique(df_train_full['ID'])
-    ids_train,ids_test = train_test_split(ids, test_size=test_share,random_state=random_state)
-    
-    df_train = df_train_full[df_train_full['ID'].isin(ids_train)]
-    df_test = df_train_full[df_train_full['ID'].isin(ids_test)]
+    df_test = df[df['ID'].isin(ids_test)]
 
-    df_demo_train = df_demo_train_full[df_demo_train_full['ID'].isin(ids_train)]
-    df_demo_test = df_demo_train_full[df_demo_train_full['ID'].isin(ids_test)]
+    df_demo_train = df_demo[df_demo['ID'].isin(ids_train)]
+    df_demo_val = df_demo[df_demo['ID'].isin(ids_val)]
+    df_demo_test = df_demo[df_demo['ID'].isin(ids_test)]
     
     
     
@@ -82,84 +71,24 @@ def df_preparer(df,variables, val_share=0.25,test_share=0.2,random_state=0,norm=
     
     # Normaize data using standardization
     if norm:
-                
-        df_train_norm = pd.DataFrame() # intialize empty normalized train, val and test set.
-        df_val_norm = pd.DataFrame()
-        df_test_norm = pd.DataFrame()
-        
-        for v in variables: # loop trough unique variables
-    
-            train_idx = (df_train.VARIABLE == v) # Define indices in train set for this variable
-            val_idx = (df_val.VARIABLE == v) # Define indices in validation set for this variable
-            test_idx = (df_test.VARIABLE == v) # Define indices in test set for this variable
-                    
-            scaler = StandardScaler()
-            scaler.fit(df_train.loc[train_idx,'VALUE'].values.reshape(-1, 1)) # Fit scaler only on training set
-            
-            temp = df_train.loc[train_idx,'VALUE'].copy() #define temporary copy of Values from training df from only this variable.
-            if temp.shape[0] == 0:
-                print(v,'not in training set')
-            else:
-                temp = scaler.transform(temp.values.reshape(-1, 1))
-                snip = df_train.loc[train_idx]
-                snip = snip.assign(VALUE=temp)
-                df_train_norm = pd.concat([df_train_norm,snip],axis=0)
-            
-            temp = df_val.loc[val_idx,'VALUE'].copy()
-            if temp.shape[0] == 0:
-                print(v,'not in validation set')
-            else:
-                temp = scaler.transform(temp.values.reshape(-1, 1))
-                snip = df_val.loc[val_idx]
-                snip = snip.assign(VALUE=temp)
-                df_val_norm = pd.concat([df_val_norm,snip],axis=0)
-            
-            temp = df_test.loc[test_idx,'VALUE'].copy()
-            if temp.shape[0] == 0:
-                print(v,'not in test set')
-            else:
-                temp = scaler.transform(temp.values.reshape(-1, 1))
-                snip = df_test.loc[test_idx]
-                snip = snip.assign(VALUE=temp)
-                df_test_norm = pd.concat([df_test_norm,snip],axis=0)
-           
-        df_train =df_train_norm    
-        df_val =df_val_norm 
-        df_test =df_test_norm 
         
-        # normalize demographics
+        scaler_table = fit_scaler_table(df_train,df_demo_train,variables) # Fit scaler only on training set
         
-        df_demo_train_norm = pd.DataFrame()
-        df_demo_val_norm = pd.DataFrame()
-        df_demo_test_norm = pd.DataFrame()
+        for name,d in [('training',df_train),('validation',df_val),('test',df_test)]:
+            for v in np.setdiff1d(variables,d['VARIABLE'].unique()):
+                print(v,'not in',name,'set')
         
-        df_demo_train_norm['ID'] = df_demo_train['ID']
-        df_demo_val_norm['ID'] = df_demo_val['ID']
-        df_demo_test_norm['ID'] = df_demo_test['ID']
+        df_train = normalize(df_train,scaler_table)
+        df_val = normalize(df_val,scaler_table)
+        df_test = normalize(df_test,scaler_table)
         
-        
-        for col in ['AGE','BMI']:
-            
-            scaler = StandardScaler()
-            scaler.fit(df_demo_train[col].values.reshape(-1, 1))
-            
-            temp = df_demo_train.loc[:,col].copy()
-            temp = scaler.transform(temp.values.reshape(-1, 1))
-            df_demo_train_norm[col] = temp
-            
-            temp = df_demo_val.loc[:,col].copy()
-            temp = scaler.transform(temp.values.reshape(-1, 1))
-            df_demo_val_norm[col] = temp
-            
-            temp = df_demo_test.loc[:,col].copy()
-            temp = scaler.transform(temp.values.reshape(-1, 1))
-            df_demo_test_norm[col] = temp
-          
-        df_demo_train = df_demo_train_norm
-        df_demo_val = df_demo_val_norm
-        df_demo_test = df_demo_test_norm
+        df_demo_train = normalize_demo(df_demo_train,scaler_table)
+        df_demo_val = normalize_demo(df_demo_val,scaler_table)
+        df_demo_test = normalize_demo(df_demo_test,scaler_table)
         
         print('data normalized using standardscaler')
+    else:
+        scaler_table = None
     
     # Make sure dfs for demographics and other variables contain same amount of patients
     assert(len(np.unique(df_train['ID']))==len(np.unique(df_demo_train['ID'])))
@@ -167,17 +96,157 @@ def df_preparer(df,variables, val_share=0.25,test_share=0.2,random_state=0,norm=
     assert(len(np.unique(df_test['ID']))==len(np.unique(df_demo_test['ID'])))
 
     # Make sure patients IDs in test/validation set are not present in train set
-    assert(any(i in np.unique(df_val['ID']) for i in np.unique(df_train['ID'])) == False)
-    assert(any(i in np.unique(df_test['ID']) for i in np.unique(df_train['ID'])) == False)
-    assert(any(i in np.unique(df_demo_val['ID']) for i in np.unique(df_demo_train['ID'])) == False)
-    assert(any(i in np.unique(df_demo_test['ID']) for i in np.unique(df_demo_train['ID'])) == False)
+    assert(len(np.intersect1d(df_val['ID'],df_train['ID'])) == 0)
+    assert(len(np.intersect1d(df_test['ID'],df_train['ID'])) == 0)
+    assert(len(np.intersect1d(df_demo_val['ID'],df_demo_train['ID'])) == 0)
+    assert(len(np.intersect1d(df_demo_test['ID'],df_demo_train['ID'])) == 0)
+
+    return df_train,df_val,df_test,df_demo_train,df_demo_val,df_demo_test,scaler_table
+    
+    
+
+def split_ids(ids,val_share=0.25,test_share=0.2,random_state=0):
+    """
+    Splits patient IDs in a train, validation and test set. The test set is taken from the patients that are not in 
+    the validation set.
+
+    Returns
+    -------
+    ids_train,ids_val,ids_test
+    type : np.array
+    """
+    from sklearn.model_selection import train_test_split
+    
+    ids_train,ids_val = train_test_split(np.unique(ids), test_size=val_share,random_state=random_state)
+    ids_train,ids_test = train_test_split(np.unique(ids_train), test_size=test_share,random_state=random_state)
+    
+    return ids_train,ids_val,ids_test
+
+
+def patient_index(df):
+    """
+    Sorts a df by ID, keeping the order of the rows within a patient, and indexes the rows of every patient. 
+    The data of a patient is then df.iloc[index[ID]], without scanning the whole df.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        df with an 'ID' column
+
+    Returns
+    -------
+    df: pd.DataFrame
+        df sorted by ID
+    index: dict
+        ID -> slice with the rows of that patient, in order of ID
+    """
+    df = df.sort_values('ID',kind='mergesort')
+    
+    ids = df['ID'].values
+    start = np.flatnonzero(np.concatenate(([True],ids[1:] != ids[:-1]))) if len(ids) else np.array([],dtype=int)
+    end = np.append(start[1:],len(ids))
+    
+    index = {ids[s]:slice(s,e) for s,e in zip(start,end)}
+    
+    return df,index
 
-    return df_train,df_val,df_test,df_demo_train,df_demo_val,df_demo_test
+
+def demographics(df,index,columns=['BMI','AGE']):
+    """
+    Extracts the demographics of every patient from the first row of that patient.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        df sorted by ID, see patient_index
+    index: dict
+        ID -> slice, see patient_index
+    columns: Optional[list[str]]
+        demographic columns
+
+    Returns
+    -------
+    df_demo: pd.DataFrame
+        df with columns ['ID'] + columns, indexed by ID
+    """
+    first = [s.start for s in index.values()]
+    
+    df_demo = df.iloc[first][['ID'] + columns]
+    df_demo.index = df_demo['ID'].values
+    
+    return df_demo
+
+
+def fit_scaler_table(df_train,df_demo_train,variables,demographics=['AGE','BMI']):
+    """
+    Fits the standardization of every variable and demographic on the training set, in one pass.
+
+    Parameters
+    ----------
+    df_train: pd.DataFrame
+        df containing training set.
+    df_demo_train: pd.DataFrame
+        demograhics df containing the training set.
+    variables: np.array[str]
+        Array with strings representing the variable names to be included in the model (excluding demographics).
+    demographics: Optional[list[str]]
+        demographic columns to be normalized.
+
+    Returns
+    -------
+    scaler_table: pd.DataFrame
+        columns ['mean','std'], indexed by the name of the variable or demographic. Like sklearn's StandardScaler,
+        the std is the population std, and 1 for constant variables. The table can be pickled or written with 
+        to_csv to normalize new data at scoring time.
+    """
+    grouped = df_train[df_train['VARIABLE'].isin(variables)].groupby('VARIABLE')['VALUE']
+    
+    table = pd.concat([pd.DataFrame({'mean':grouped.mean(),'std':grouped.std(ddof=0)}),
+                       pd.DataFrame({'mean':df_demo_train[demographics].mean(),'std':df_demo_train[demographics].std(ddof=0)})])
+    table.loc[~(table['std'] > 0),'std'] = 1.0
+    
+    return table
+
+
+def normalize(df,scaler_table):
+    """
+    Standardizes the values of a df with data of any set, using a scaler table from fit_scaler_table.
+    Rows of variables that are not in the scaler table are dropped.
+
+    Returns
+    -------
+    df: pd.DataFrame
+        copy of df with normalized 'VALUE' column
+    """
+    df = df[df['VARIABLE'].isin(scaler_table.index)]
+    
+    mean = df['VARIABLE'].map(scaler_table['mean'])
+    std = df['VARIABLE'].map(scaler_table['std'])
+    
+    return df.assign(VALUE=(df['VALUE'] - mean)/std)
+
+
+def normalize_demo(df_demo,scaler_table,demographics=['AGE','BMI']):
+    """
+    Standardizes the demographics, using a scaler table from fit_scaler_table.
+
+    Returns
+    -------
+    df_demo: pd.DataFrame
+        df with columns ['ID'] + demographics
+    """
+    df_demo_norm = pd.DataFrame({'ID':df_demo['ID']})
     
+    for col in demographics:
+        df_demo_norm[col] = (df_demo[col] - scaler_table.loc[col,'mean'])/scaler_table.loc[col,'std']
     
+    return df_demo_norm
+
 
-def prepare_feature_vectors(df,df_train,df_demo,df_demo_train,df_patients,ids_IC_only,ids_events,pred_window,gap,int_neg,int_pos,feature_window,
-                        features,label_type='mortality'):
+@instrumented('prepare_feature_vectors',rows=lambda a,out: len(a['df']),vectors=lambda a,out: len(out[1]))
+def prepare_feature_vectors(df,df_demo,imputer,pred_window,gap,int_neg,int_pos,feature_window,
+                        features,label_type='mortality',legacy=False,n_jobs=1,chunk_size=200,return_plan=False,dtype=np.float64,
+                        sampling='parchure',events=None,kernels=None):
     print('prepare_feature_vectors triggered')
 
     """
@@ -187,12 +256,10 @@ def prepare_feature_vectors(df,df_train,df_demo,df_demo_train,df_patients,ids_IC
     ----------
     df : pd.DataFrame
         df to sample from.
-    df_train: pd.DataFrame
-        df containing training set. Imputed values are based on the training set. 
     df_demo: pd.DataFrame
         demograhics df to sample from.
-    df_demo_train: pd.DataFrame
-        demograhics df containing the training set. Imputed values are based on the training set. 
+    imputer: Imputer
+        imputation statistics of the training set, see classes.Imputer
     pred_window: int
         Size of prediction window in hours
     gap: int
@@ -205,6 +272,26 @@ def prepare_feature_vectors(df,df_train,df_demo,df_demo_train,df_patients,ids_IC
         Number of most recent assessments to be included in feature vector
     variables: np.array[str]
         Array of strings representing the names of the variables to be included in the model.
+    label_type: Optional[str]
+        name in LABEL_TYPES, e.g. 'mortality' or 'ICU'
+    legacy: Optional[bool]
+        If True, use the original per-patient / per-timestamp loop (create_feature_window for every vector).
+        If False, use the vectorized engine, which produces the same X and y.
+    n_jobs: Optional[int]
+        Number of worker processes for the vectorized engine, -1 for all cores. 
+    chunk_size: Optional[int]
+        Number of patients per chunk of the vectorized engine (per task if n_jobs > 1).
+    return_plan: Optional[bool]
+        If True, also return the patient ID and sample timestamp of every feature vector.
+    dtype: Optional[np.dtype]
+        dtype of X, e.g. np.float32 to halve its memory. The columns are described by feature_layout.
+    sampling: Optional[str]
+        sampling strategy, see sampling_plan. The legacy loop only supports 'parchure'.
+    events: Optional[pd.DataFrame]
+        event times per patient (see event_index), e.g. computed once for all label types and splits.
+    kernels: Optional[dict]
+        summary features per variable (e.g. mean and slope over the last 24 hours), added after the n most recent
+        values, see kernel_specs. Not supported by the legacy loop.
 
 
     Returns
@@ -212,123 +299,872 @@ def prepare_feature_vectors(df,df_train,df_demo,df_demo_train,df_patients,ids_IC
     X: matrix [N feature vectors x N variables]
     y: vector [N feature vectors x 1]
     type : np.array
+    plan: pd.DataFrame
+        Only if return_plan is True. Columns ['ID','TIME'], one row per feature vector (row of X).
+    """
+
+    if events is None or label_type not in events.columns:
+        events = event_index(df,[label_type])
+    df_pos,df_neg = split_on_label(df,label_type,events)
+
+    print('pos df:',df_pos.shape, '-->',len(df_pos['ID'].unique()), 'patients')
+    print('neg df:',df_neg.shape, '-->',len(df_neg['ID'].unique()), 'patients')
+
+    if legacy:
+        if sampling != 'parchure':
+            raise ValueError('the legacy engine only supports parchure sampling')
+        if kernels:
+            raise ValueError('the legacy engine does not support feature kernels')
+        pos,neg,count = feature_vectors_loop(df_pos,df_neg,df_demo,imputer,pred_window,gap,int_neg,int_pos,
+                                             feature_window,features,label_type)
+        plan,_ = sampling_plan(df_pos,df_neg,pred_window,gap,int_neg,int_pos,label_type,events=events) if return_plan else (None,0)
+
+        X = np.concatenate((pos, neg), axis=0).astype(dtype,copy=False)
+        y = np.concatenate((np.ones(pos.shape[0]),np.zeros(neg.shape[0])),axis=0)
+    else:
+        # rows are already positive first, so X is used as built
+        X,y,count,plan = feature_vectors_vectorized(df_pos,df_neg,df_demo,imputer,pred_window,gap,int_neg,int_pos,
+                                                    feature_window,features,label_type,n_jobs,chunk_size,dtype,sampling,
+                                                    events,kernels)
+
+    n_pos = int((y == 1).sum())
+    print('number of patients with too little data for feature vector: ', count)            
+    print('shape of positive class: ', (n_pos,X.shape[1]), 'shape of negative class: ', (X.shape[0] - n_pos,X.shape[1]))
+
+    print(X.shape)
+    assert(np.isnan(X).any() == False)
+    print(y.shape)
+    assert(np.isnan(y).any() == False)
+
+    if return_plan:
+        return X, y, plan[['ID','TIME']]
+
+    return X, y     
+
+
+def mortality_rows(df):
+    # patients who died: the event is their last measurement
+    return df['DEST'].str.contains('died',na=False)
+
+
+def icu_rows(df):
+    # measurements at the IC department: the event is the first of them
+    return df['DEPARTMENT'].isin(['IC','ICU'])
+
+
+# label types: name -> (function(df) -> bool per row, aggregation of the TIME of these rows per patient)
+# e.g. LABEL_TYPES['ventilation'] = (lambda df: df['VARIABLE'] == 'FiO2', 'min')
+LABEL_TYPES = {'mortality':(mortality_rows,'max'),'ICU':(icu_rows,'min')}
+
+
+def event_index(df,label_types=None):
+    """
+    Event time per patient for one or more label types, in a single groupby over the data.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        long format data
+    label_types: Optional[list[str]]
+        names in LABEL_TYPES, all if None
+
+    Returns
+    -------
+    events: pd.DataFrame
+        indexed by patient ID, one column per label type with the event time (NaT for patients without the event)
+    """
+    label_types = list(LABEL_TYPES) if label_types is None else list(label_types)
+    for label_type in label_types:
+        if label_type not in LABEL_TYPES:
+            raise ValueError('unknown label_type: ' + str(label_type))
+
+    times = pd.DataFrame({label_type:df['TIME'].where(LABEL_TYPES[label_type][0](df)) for label_type in label_types})
+    events = times.groupby(df['ID'].values).agg({label_type:LABEL_TYPES[label_type][1] for label_type in label_types})
+
+    return events.rename_axis('ID')
+
+
+def split_on_label(df,label_type='mortality',events=None):
+    """
+    Splits a df in the data of positive and negative patients.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        df to split.
+    label_type: Optional[str]
+        name in LABEL_TYPES, e.g. 'mortality' or 'ICU'
+    events: Optional[pd.DataFrame]
+        see event_index, computed from df if None or if label_type is not one of its columns
+
+    Returns
+    -------
+    df_pos,df_neg
+    type : pd.DataFrame
     """
+    print('Label for',label_type)
+
+    if events is None or label_type not in events.columns:
+        events = event_index(df,[label_type])
+
+    is_pos = df['ID'].isin(events.index[events[label_type].notna()])
 
+    return df[is_pos],df[~is_pos]
+
+
+@instrumented('feature_vectors_loop',rows=lambda a,out: len(a['df_pos']) + len(a['df_neg']),
+              vectors=lambda a,out: len(out[0]) + len(out[1]))
+def feature_vectors_loop(df_pos,df_neg,df_demo,imputer,pred_window,gap,int_neg,int_pos,feature_window,
+                         features,label_type='mortality'):
+    """
+    Original sampling loop: one pass over the data of a patient per timestamp, and one create_feature_window call per 
+    feature vector. Kept as reference implementation for feature_vectors_vectorized.
+
+    Returns
+    -------
+    pos: matrix [N positive feature vectors x N variables]
+    neg: matrix [N negative feature vectors x N variables]
+    count: int
+        number of patients with too little data for a feature vector
+    """
     from datetime import datetime, timedelta
 
     pos = list() #create empty list for pos labeled feature vectors
     neg = list() #create empty list for neg labeled feature vectors
+
+    print('-----Sampling for positive patients-----') 
+
+    count = 0 
+
+    latency = [] # seconds per patient
+
+    df_pos,index = patient_index(df_pos)
+
+    for idx in index: # loop over patients
+        # print(idx)
+        start = time.perf_counter()
+        patient = df_pos.iloc[index[idx]].sort_values(by='TIME',kind='mergesort').reset_index(drop=True) # Extract data of single patient, sort by date
+
+        t_event = event_index(patient,[label_type])[label_type].iloc[0] # e.g. first ICU measurement, or last measurement
+            
+            
+        if (t_event - patient['TIME'].min()).total_seconds()/3600 < gap: # cannot label patients for which time between start and event is shorter than the gap
+            count += 1
+        else:
+
+            #For positive feature vectors of positive patient
+            ts = []            
+            t = t_event - timedelta(hours=gap) #initialize t
+            window = pred_window
+
+            for i in range(int(window/int_pos)-1): # Make array with timestamps to sample from, making steps of size 'int_pos'
+                ts.append(t)
+                t = t - timedelta(hours=int_pos)
+
+            for t in ts: 
+
+                temp = patient[patient['TIME'] <= t].reset_index(drop=True)
+
+                v = create_feature_window(temp,df_demo,imputer,feature_window,features,idx)
+                pos.append(v)
+
+            # For Negative feature vectors of positive patients
+            ts = []            
+            t = t_event - timedelta(hours=gap+pred_window) #initialize t 
+            window = (t_event - patient['TIME'].min()).total_seconds()/3600 - pred_window - gap # window to sample from is full window - prediction window and gap
+
+            for i in range(int(window/int_neg)-1): # Make array with timestamps to sample from, making steps of size 'int_neg'
+                ts.append(t)
+                t = t - timedelta(hours=int_neg)
+
+            for t in ts: 
+
+                temp = patient[patient['TIME'].dt.normalize() <= t].reset_index(drop=True) # Extract snippet before this day
+
+                v = create_feature_window(temp,df_demo,imputer,feature_window,features,idx)
+                neg.append(v)
+
+        latency.append(time.perf_counter() - start)
+
+    print('-----Sampling for negative patient-----')
+
+    df_neg,index = patient_index(df_neg)
+
+    for idx in index: # loop over patients
+        # print(idx)
+        start = time.perf_counter()
+        patient = df_neg.iloc[index[idx]].sort_values(by='TIME',kind='mergesort').reset_index(drop=True) # Extract data of single patient, sort by date
+
+        if (patient['TIME'].max() - patient['TIME'].min()).total_seconds()/3600 < gap: # cannot label patients with stay shorter than the gap
+            count+= 1
+
+        else:
+            ts = []            
+            t = patient['TIME'].max() #initialize t 
+            window = (patient['TIME'].max() - patient['TIME'].min()).total_seconds()/3600 # window to sample from is full window 
+
+            for i in range(int(window/int_neg)-1): # Make array with timestamps to sample from, making steps of size 'int_neg'
+                ts.append(t)
+                t = t - timedelta(hours=int_neg)
+
+            for t in ts: 
+
+                temp = patient[patient['TIME'].dt.normalize() <= t].reset_index(drop=True) # Extract snippet before this day
+
+                v = create_feature_window(temp,df_demo,imputer,feature_window,features,idx)
+                neg.append(v)
+
+        latency.append(time.perf_counter() - start)
+
+    observe('patient_latency_s',latency)
+
+    n_cols = len(df_demo.columns[1:]) + feature_window*len(features)
+    pos = np.array([np.array(x) for x in pos]).reshape(-1,n_cols)
+    neg = np.array([np.array(x) for x in neg]).reshape(-1,n_cols)
+
+    return pos,neg,count
+
+
+@instrumented('feature_vectors_vectorized',rows=lambda a,out: len(a['df_pos']) + len(a['df_neg']),
+              vectors=lambda a,out: len(out[3]))
+def feature_vectors_vectorized(df_pos,df_neg,df_demo,imputer,pred_window,gap,int_neg,int_pos,feature_window,
+                               features,label_type='mortality',n_jobs=1,chunk_size=200,dtype=np.float64,sampling='parchure',
+                               events=None,kernels=None):
+    """
+    Vectorized version of feature_vectors_loop. The sample timestamps of all patients are collected first, after which
+    all 'last n values as of t' lookups are done at once on a single copy of the data sorted by (ID, VARIABLE, TIME).
+
+    Returns
+    -------
+    X: matrix [N feature vectors x N variables]
+        positive feature vectors first, then the negative ones
+    y: np.array
+        label per feature vector
+    count: int
+        number of patients with too little data for a feature vector
+    plan: pd.DataFrame
+        sampling plan, see sampling_plan. One row per row of X.
+    """
+    plan,count = sampling_plan(df_pos,df_neg,pred_window,gap,int_neg,int_pos,label_type,sampling,events)
+
+    print('-----Building',plan.shape[0],'feature vectors-----')
+
+    if n_jobs == 1:
+        X = feature_matrix_chunked(pd.concat([df_pos,df_neg]),df_demo,imputer,plan['ID'].values,
+                                   plan['CUTOFF'].values,feature_window,features,chunk_size,dtype,kernels)
+    else:
+        X = feature_matrix_parallel(pd.concat([df_pos,df_neg]),df_demo,imputer,plan['ID'].values,
+                                    plan['CUTOFF'].values,feature_window,features,n_jobs,chunk_size,dtype,kernels)
+
+    return X,plan['LABEL'].values.astype(float),count,plan
+
+
+def stay_table(df_pos,df_neg,label_type='mortality',events=None):
+    """
+    First and last measurement and event time per patient, computed with one groupby per column.
+
+    Parameters
+    ----------
+    events: Optional[pd.DataFrame]
+        see event_index, computed from df_pos if None or if label_type is not one of its columns
+
+    Returns
+    -------
+    stays: pd.DataFrame
+        columns ['ID','START','END','EVENT'], positive patients first. EVENT is NaT for negative patients. The event
+        time is defined by LABEL_TYPES, e.g. the last measurement for 'mortality' and the first measurement at the
+        IC department for 'ICU'.
+    """
+    if events is None or label_type not in events.columns:
+        events = event_index(df_pos,[label_type])
+
+    tables = []
+    for df,positive in [(df_pos,True),(df_neg,False)]:
+        times = df.groupby('ID')['TIME']
+        stays = pd.DataFrame({'START':times.min(),'END':times.max()})
+        stays['EVENT'] = events[label_type].reindex(stays.index) if positive else pd.NaT
+        tables.append(stays)
+
+    stays = pd.concat(tables).rename_axis('ID').reset_index()
+    stays['EVENT'] = pd.to_datetime(stays['EVENT'])
+
+    return stays
+
+
+_HOUR = 3600*10**9 # nanoseconds
+_DAY = 24*_HOUR
+
+def _ns(times):
+    # datetime column as int64 nanoseconds (NaT becomes the minimum int64)
+    return times.values.astype('datetime64[ns]').astype(np.int64)
+
+def _sample_times(ids,anchor,step,counts,label,whole_day):
+    # counts[i] timestamps anchor[i], anchor[i] - step, ... per patient, as one flat table
+    counts = np.maximum(counts,0).astype(np.int64)
+    rows = np.repeat(np.arange(len(counts)),counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,counts)
+    t = anchor[rows] - k*step
     
-    if label_type == 'mortality':
-        print('Label for mortality')
-        
-        df_pos = df[df['DEST'].contains('died')] 
-        df_neg = df[~df['DEST'].contains('died')]
+    # negative vectors use all measurements until the end of the day of the timestamp
+    cutoff = t - t % _DAY + _DAY - 1 if whole_day else t
+
+    return pd.DataFrame({'ID':np.asarray(ids)[rows],'TIME':t.astype('datetime64[ns]'),
+                         'CUTOFF':cutoff.astype('datetime64[ns]'),'LABEL':np.full(len(t),label)})
+
+
+def parchure_plan(stays,pred_window,gap,int_neg,int_pos):
+    """
+    Sampling of Parchure et al., identical to feature_vectors_loop: for positive patients, positive vectors every 
+    int_pos hours in the pred_window before event - gap, and negative vectors every int_neg hours before that. For 
+    negative patients, negative vectors every int_neg hours back from the last measurement. Negative vectors use 
+    the measurements until the end of the day of their timestamp.
+
+    Parameters
+    ----------
+    stays: pd.DataFrame
+        see stay_table
+
+    Returns
+    -------
+    plan, count: see sampling_plan
+    """
+    start = _ns(stays['START'])
+    end = _ns(stays['END'])
+    positive = stays['EVENT'].notna().values
+    event = np.where(positive,_ns(stays['EVENT']),end)
+    ids = stays['ID'].values
+
+    too_short = (event - start)/_HOUR < gap
+    pos = positive & ~too_short
+    neg = ~positive & ~too_short
+
+    window = (event[pos] - start[pos])/_HOUR - pred_window - gap
+    plan = pd.concat([_sample_times(ids[pos],event[pos] - gap*_HOUR,int_pos*_HOUR,
+                                    np.full(pos.sum(),int(pred_window/int_pos) - 1),1,False),
+                      _sample_times(ids[pos],event[pos] - (gap + pred_window)*_HOUR,int_neg*_HOUR,
+                                    np.trunc(window/int_neg) - 1,0,True),
+                      _sample_times(ids[neg],end[neg],int_neg*_HOUR,np.trunc((end[neg] - start[neg])/_HOUR/int_neg) - 1,
+                                    0,True)],ignore_index=True)
+
+    return plan,int(too_short.sum())
+
+
+def whole_stay_plan(stays,pred_window,gap,int_neg,int_pos):
+    """
+    Sampling over the whole stay: every patient is sampled every int_neg hours, back from event - gap (positive 
+    patients) or the last measurement (negative patients) to the first measurement. A vector is positive if the 
+    event follows within gap + pred_window hours. Vectors use the measurements until their timestamp. int_pos is 
+    not used.
+
+    Parameters
+    ----------
+    stays: pd.DataFrame
+        see stay_table
+
+    Returns
+    -------
+    plan, count: see sampling_plan
+    """
+    start = _ns(stays['START'])
+    positive = stays['EVENT'].notna().values
+    event = _ns(stays['EVENT'])
+    horizon = np.where(positive,event - gap*_HOUR,_ns(stays['END']))
+
+    too_short = horizon < start
+    counts = np.where(too_short,0,(horizon - start)//(int_neg*_HOUR) + 1)
+
+    plan = _sample_times(stays['ID'].values,horizon,int_neg*_HOUR,counts,0,False)
+    rows = np.repeat(np.arange(len(stays)),counts)
+    plan['LABEL'] = (positive[rows] & (event[rows] - _ns(plan['TIME']) <= (gap + pred_window)*_HOUR)).astype(int)
+
+    return plan,int(too_short.sum())
+
+
+# sampling strategies for sampling_plan: function(stays,pred_window,gap,int_neg,int_pos) -> (plan,count)
+SAMPLING_STRATEGIES = {'parchure':parchure_plan,'whole_stay':whole_stay_plan}
+
+
+@instrumented('sampling_plan',vectors=lambda a,out: len(out[0]))
+def sampling_plan(df_pos,df_neg,pred_window,gap,int_neg,int_pos,label_type='mortality',strategy='parchure',events=None):
+    """
+    Computes the sample timestamps of all patients as one flat table. The stay of every patient is summarized once
+    (stay_table), after which the timestamps of all patients are generated at once by a sampling strategy.
+    With strategy 'parchure' the plan is in the same order as feature_vectors_loop.
+
+    Parameters
+    ----------
+    df_pos : pd.DataFrame
+        data of positive patients.
+    df_neg : pd.DataFrame
+        data of negative patients.
+    pred_window, gap, int_neg, int_pos: int
+        see prepare_feature_vectors
+    label_type: Optional[str]
+        'mortality' or 'ICU'
+    strategy: Optional[str]
+        name in SAMPLING_STRATEGIES: 'parchure' (see parchure_plan) or 'whole_stay' (see whole_stay_plan)
+    events: Optional[pd.DataFrame]
+        precomputed event times, see event_index
+
+    Returns
+    -------
+    plan: pd.DataFrame
+        One row per feature vector with columns ['ID','TIME','CUTOFF','LABEL']. CUTOFF is the last moment (inclusive) 
+        of which measurements are used for the feature vector. Positive vectors first.
+    count: int
+        number of patients with too little data for a feature vector
+    """
+    if strategy not in SAMPLING_STRATEGIES:
+        raise ValueError('unknown sampling strategy: ' + str(strategy))
+
+    plan,count = SAMPLING_STRATEGIES[strategy](stay_table(df_pos,df_neg,label_type,events),pred_window,gap,int_neg,int_pos)
+    
+    # positive vectors first, in order of patient
+    plan = plan.sort_values('LABEL',ascending=False,kind='mergesort').reset_index(drop=True)
+
+    return plan,count
+
+
+def sorted_series(df,variables):
+    """
+    Sorts the data once by (ID, VARIABLE, TIME), so every (patient, variable) is a contiguous block. 
+    Used by feature_matrix, and can be reused for any number of sample timestamps and feature windows.
+
+    Returns
+    -------
+    series: dict
+        'patients': pd.Index with the patient IDs
+        'key': block number per measurement (patient number * number of variables + variable number)
+        'times': time per measurement, as int64 nanoseconds
+        'values': value per measurement
+    """
+    n_var = len(variables)
+    
+    df = df[df['VARIABLE'].isin(variables)]
+    patients = pd.Index(pd.unique(df['ID']))
+    key = patients.get_indexer(df['ID'])*n_var + pd.Index(variables).get_indexer(df['VARIABLE'])
+    times = df['TIME'].values.astype('datetime64[ns]').view('int64')
+    order = np.lexsort((times,key))
+    
+    return {'patients':patients,'key':key[order],'times':times[order],'values':df['VALUE'].values[order].astype(float)}
+
+
+@instrumented('feature_matrix',rows=lambda a,out: len(a['df']),vectors=lambda a,out: len(a['ids']))
+def feature_matrix(df,df_demo,imputer,ids,cutoffs,n,variables,series=None,dtype=np.float64,kernels=None):
+    """
+    Builds the feature vectors for many (patient, cutoff) pairs at once. Gives the same result as calling 
+    create_feature_window on the data of patient ids[i] until cutoffs[i], for every i, followed by the summary 
+    features of kernels if given.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        df with the data of the patients
+    df_demo: pd.DataFrame
+        demograhics df to sample from, indexed by ID.
+    imputer: Imputer
+        imputation statistics of the training set, see classes.Imputer
+    ids: np.array
+        patient ID per feature vector
+    cutoffs: np.array[datetime64]
+        last moment (inclusive) of data to be used per feature vector
+    n: int
+        feature_window
+    variables: np.array[str]
+        Array of strings representing the names of the variables to be included in the model.
+    series: Optional[dict]
+        Output of sorted_series(df,variables). Can be given to reuse the sorted data for several calls, df is not 
+        used then.
+    dtype: Optional[np.dtype]
+        dtype of X
+    kernels: Optional[dict]
+        summary features per variable, see FEATURE_KERNELS and kernel_specs
+
+    Returns
+    -------
+    X: matrix [N feature vectors x N variables], C-contiguous, columns as in feature_layout
+    type : np.array
+    """
+    ids = np.asarray(ids)
+    cutoffs = np.asarray(cutoffs,dtype='datetime64[ns]').view('int64')
+    n_vec = len(ids)
+    n_var = len(variables)
+
+    # Demographics, imputed with the statistics of the training set
+    demo_cols = df_demo.columns[1:]
+    demo = df_demo[demo_cols].reindex(ids).fillna(imputer.demo[demo_cols])
+
+    # Statistics of the training set, used if a variable was never measured
+    medians = imputer.values.reindex(variables).values.astype(dtype)
+
+    if series is None:
+        series = sorted_series(df,variables)
+    patients,key,times = series['patients'],series['key'],series['times']
+    # values in the dtype of X, converted once per series (no copy for float64)
+    values = _cached(series,'values_' + np.dtype(dtype).name,lambda: series['values'].astype(dtype,copy=False))
+
+    # Block of every (feature vector, variable) pair
+    q_key = (patients.get_indexer(ids)[:,None]*n_var + np.arange(n_var)[None,:]).ravel()
+    q_key[np.repeat(patients.get_indexer(ids) < 0,n_var)] = -1
+    q_cutoff = np.repeat(cutoffs,n_var)
+    start = np.searchsorted(key,q_key,side='left')
+    end = np.searchsorted(key,q_key,side='right')
+
+    # number of measurements until cutoff, per block
+    k = _search_blocks(times,start,end,q_cutoff) - start
+
+    # X is allocated once, the demographics, windows and summary features are written into their columns
+    n_demo = len(demo_cols)
+    n_summary = len(kernel_specs(kernels,variables)) if kernels else 0
+    X = np.empty((n_vec,n_demo + n_var*n + n_summary),dtype=dtype)
+    X[:,:n_demo] = demo.values
+
+    # n most recent values, padded with the most recent value if less than n are available
+    window = X[:,n_demo:n_demo + n_var*n].reshape(n_vec,n_var,n) # a view on X
+    if len(values):
+        lag = np.arange(n)[None,:]
+        pos = start[:,None] + np.minimum(np.maximum(k-n,0)[:,None] + lag, k[:,None]-1)
+        window[:] = values[np.clip(pos,0,len(values)-1)].reshape(n_vec,n_var,n)
+    empty = (k == 0).reshape(n_vec,n_var)
+    window[empty] = np.broadcast_to(medians,(n_vec,n_var))[empty][:,None]
+
+    if kernels:
+        summary_features(series,start,start + k,q_cutoff,medians,variables,kernels,dtype,out=X[:,n_demo + n_var*n:])
+
+    return X
+
+
+def _search_blocks(times,start,end,cutoff):
+    # first position in every block [start,end) with a time > cutoff (binary search in all blocks at once)
+    lo,hi = start.copy(),end.copy()
+    while (lo < hi).any():
+        mid = (lo + hi)//2
+        right = (lo < hi) & (times[np.minimum(mid,len(times)-1)] <= cutoff)
+        left = (lo < hi) & ~right
+        lo[right] = mid[right] + 1
+        hi[left] = mid[left]
+
+    return lo
+
+
+def _cached(series,name,fn):
+    # array derived from the sorted series, computed on first use and kept in the series dict for the next call
+    if name not in series:
+        series[name] = fn()
+    return series[name]
+
+
+def _block_cumsum(series,a):
+    # cumulative sum of a within every block; restarting per block keeps the sums, and so the rounding errors of the
+    # window sums, independent of the other patients
+    return pd.Series(a).groupby(series['key']).cumsum().values
+
+
+def _window_sum(cs,w):
+    # sum over the windows [left,end) from the block cumulative sum cs, 0 if there are no measurements at all
+    if len(cs) == 0:
+        return np.zeros(len(w['end']))
+
+    before = np.where(w['left'] > w['start'],cs[np.maximum(w['left'] - 1,0)],0)
+    total = np.where(w['end'] > w['start'],cs[np.maximum(w['end'] - 1,0)],0)
+
+    return np.where(w['end'] > w['left'],total - before,0)
+
+
+def _kernel_mean(series,w):
+    # mean of the values in the window, from a cumulative sum
+    cs = _cached(series,'cumsum',lambda: _block_cumsum(series,series['values']))
+    count = w['end'] - w['left']
+
+    return np.where(count > 0,_window_sum(cs,w)/np.maximum(count,1),w['median'])
+
+
+def _window_reduce(series,w,ufunc):
+    # ufunc.reduceat over the windows [left,end), a sentinel keeps the indices in range
+    values = _cached(series,'padded',lambda: np.r_[series['values'],0])
+    bounds = np.stack((w['left'],w['end']),axis=1).ravel()
+    reduced = ufunc.reduceat(values,bounds)[::2] if len(bounds) else np.zeros(0)
+
+    return np.where(w['end'] > w['left'],reduced,w['median'])
+
+
+def _kernel_min(series,w):
+
+    return _window_reduce(series,w,np.minimum)
+
+
+def _kernel_max(series,w):
+
+    return _window_reduce(series,w,np.maximum)
+
+
+def _kernel_slope(series,w):
+    # least squares slope in value per hour, from cumulative sums of t, t^2, v and t*v. t is in hours since the first
+    # measurement of the block. 0 if the window has less than two distinct times.
+    def hours():
+        first = np.searchsorted(series['key'],series['key'],side='left')
+        return (series['times'] - series['times'][first])/_HOUR
+
+    t = _cached(series,'block_hours',hours)
+    sums = _cached(series,'slope_sums',lambda: [_block_cumsum(series,a) for a in [t,t*t,t*series['values']]])
+    cs_v = _cached(series,'cumsum',lambda: _block_cumsum(series,series['values']))
+    count = w['end'] - w['left']
+    st,stt,stv = [_window_sum(c,w) for c in sums]
+    sv = _window_sum(cs_v,w)
+    sxx = count*stt - st*st
+    ok = (count > 1) & (sxx > 1e-9*np.maximum(count*stt,1))
+
+    return np.where(ok,(count*stv - st*sv)/np.where(ok,sxx,1),0.0)
+
+
+def _kernel_since_last(series,w):
+    # hours since the last measurement, at most the window (also if there is none)
+    last = series['times'][np.maximum(w['end'] - 1,0)] if len(series['times']) else np.zeros(len(w['end']),np.int64)
+    since = (w['cutoff'] - last)/_HOUR
+
+    return np.where(w['end'] > w['start'],np.minimum(since,w['hours']),w['hours'])
 
-    elif label_type == 'ICU':
-        print('label for ICU admission')
 
-        df_pos = df[df['DEPARTMENT'].contains('ICU')] 
-        df_neg = df[~df['DEPARTMENT'].contains('ICU')]
+def _kernel_count(series,w):
 
-    print('pos df:',df_pos.shape, '-->',len(df_pos['ID'].unique()), 'patients')
-    print('neg df:',df_neg.shape, '-->',len(df_neg['ID'].unique()), 'patients')
+    return (w['end'] - w['left']).astype(float)
 
-    print('-----Sampling for positive patients-----') 
 
-    count = 0 
+# summary feature -> function of (sorted series, windows) that returns one value per window. The windows are a dict
+# of arrays with one element per (feature vector, variable): 'start' and 'end' (block positions of the first and after
+# the last measurement until the cutoff), 'left' (first measurement in the last 'hours' hours), 'cutoff' (int64 ns),
+# 'median' (imputation value of the variable) and the scalar 'hours'. Extra kernels can be added here.
+FEATURE_KERNELS = {'mean':_kernel_mean,
+                   'min':_kernel_min,
+                   'max':_kernel_max,
+                   'slope':_kernel_slope,
+                   'since_last':_kernel_since_last,
+                   'count':_kernel_count}
 
-    for idx in np.unique(df_pos['ID']): # loop over patients
-        # print(idx)
-        patient = df_pos[df_pos['ID']==idx].sort_values(by='TIME').reset_index(drop=True) # Extract data of single patient, sort by date
 
-        if label_type == 'ICU':
-            t_event = patient[patient['DEPARTMENT']=='IC']['TIME'].min() # define moment of ICU admission as first ICU measurement
-        elif label_type == 'mortality':
-            t_event = patient['TIME'].max() 
-            
-            
-        if (t_event - patient['TIME'].min()).total_seconds()/3600 < gap: # cannot label patients for which time between start and event is shorter than the gap
-            count += 1
-        else:
+def kernel_specs(kernels,variables):
+    """
+    Expands a kernel configuration to a list of (variable, kernel, hours), in the column order of the summary features.
 
-            #For positive feature vectors of positive patient
-            ts = []            
-            t = t_event - timedelta(hours=gap) #initialize t
-            window = pred_window
+    Parameters
+    ----------
+    kernels: dict
+        variable -> list of (kernel, hours), e.g. {'HR':[('mean',24),('slope',24)],'CRP':[('since_last',72)]}. 
+        Kernels are the keys of FEATURE_KERNELS, hours None means all data until the cutoff. The key '*' applies to 
+        every variable without an entry of its own.
+    variables: np.array[str]
+        variables of the model
 
-            for i in range(int(window/int_pos)-1): # Make array with timestamps to sample from, making steps of size 'int_pos'
-                ts.append(t)
-                t = t - timedelta(hours=int_pos)
+    Returns
+    -------
+    specs: list[tuple]
+    """
+    specs = []
+    for v in variables:
+        for kernel,hours in kernels.get(v,kernels.get('*',[])):
+            if kernel not in FEATURE_KERNELS:
+                raise ValueError('unknown feature kernel: ' + str(kernel))
+            if kernel == 'since_last' and hours is None:
+                raise ValueError('since_last needs a window in hours')
+            specs.append((v,kernel,hours))
+    for v in kernels:
+        if v != '*' and v not in list(variables):
+            raise ValueError('feature kernels for unknown variable: ' + str(v))
 
-            for t in ts: 
+    return specs
 
-                temp = patient[patient['TIME'] <= t].reset_index(drop=True)
 
-                v,med_share,ff_share,med_spec,ff_spec = create_feature_window(temp,df_train,df_demo,df_demo_train,feature_window,features,idx)
-                pos.append(v)
+def summary_features(series,start,end,cutoffs,medians,variables,kernels,dtype=np.float64,out=None):
+    """
+    Computes the summary features of kernels for every (feature vector, variable) block at once, see feature_matrix.
+    Every distinct window length is searched once for all blocks; every kernel is a few array operations over all
+    feature vectors, there is no loop over feature vectors or timestamps.
 
-            # For Negative feature vectors of positive patients
-            ts = []            
-            t = t_event - timedelta(hours=gap+pred_window) #initialize t 
-            window = (t_event - patient['TIME'].min()).total_seconds()/3600 - pred_window - gap # window to sample from is full window - prediction window and gap
+    Parameters
+    ----------
+    series: dict
+        see sorted_series
+    start, end: np.array
+        per (feature vector, variable), row-major: position of the first measurement of the block and after the last
+        measurement until the cutoff
+    cutoffs: np.array
+        cutoff per (feature vector, variable), int64 nanoseconds
+    medians: np.array
+        imputation value per variable
+    variables: np.array[str]
+    kernels: dict
+        see kernel_specs
+    out: Optional[np.array]
+        matrix [N feature vectors x N summary features] to write into, e.g. the summary columns of X
 
-            for i in range(int(window/int_neg)-1): # Make array with timestamps to sample from, making steps of size 'int_neg'
-                ts.append(t)
-                t = t - timedelta(hours=int_neg)
+    Returns
+    -------
+    S: matrix [N feature vectors x N summary features], columns as in feature_layout
+    """
+    specs = kernel_specs(kernels,variables)
+    n_var = len(variables)
+    n_vec = len(start)//max(n_var,1)
+    position = {v:i for i,v in enumerate(variables)}
 
-            for t in ts: 
+    S = np.empty((n_vec,len(specs)),dtype=dtype) if out is None else out
+    lefts = {}
+    for j,(v,kernel,hours) in enumerate(specs):
+        if hours not in lefts:
+            lefts[hours] = start if hours is None else _search_blocks(series['times'],start,end,cutoffs - int(hours*_HOUR))
+        pairs = np.arange(n_vec)*n_var + position[v]
+        w = {'start':start[pairs],'end':end[pairs],'left':lefts[hours][pairs],'cutoff':cutoffs[pairs],
+             'median':np.full(n_vec,medians[position[v]]),'hours':hours}
+        S[:,j] = FEATURE_KERNELS[kernel](series,w)
 
-                temp = patient[patient['TIME'].dt.date <= t].reset_index(drop=True) # Extract snippet before this day
+    return S
+   
+    
 
-                v,med_share,ff_share,med_spec,ff_spec = create_feature_window(temp,df_train,df_demo,df_demo_train,feature_window,features,idx)
-                neg.append(v)
+    
+def feature_layout(demographics,variables,n,kernels=None):
+    """
+    Describes the columns of the feature vectors: first the demographics, then for every variable its n most recent 
+    values, oldest first, then the summary features of kernels.
 
-    print('-----Sampling for negative patient-----')
+    Parameters
+    ----------
+    demographics: list[str]
+        demographic columns, in the order of df_demo
+    variables: np.array[str]
+        Array of strings representing the names of the variables to be included in the model.
+    n: int
+        feature_window
+    kernels: Optional[dict]
+        summary features, see kernel_specs
 
-    for idx in np.unique(df_neg['ID']): # loop over patients
-        # print(idx)
-        patient = df_neg[df_neg['ID']==idx].sort_values(by='TIME').reset_index(drop=True) # Extract data of single patient, sort by date
+    Returns
+    -------
+    layout: pd.DataFrame
+        one row per column of X, with the columns ['name','variable','lag','summary']. lag is the number of 
+        assessments before the most recent one (0 for the most recent one, -1 for demographics and summaries), 
+        summary is e.g. 'mean_24h' for summary features and None otherwise.
+    """
+    rows = [(col,col,-1,None) for col in demographics]
+    rows += [('{}_lag{}'.format(v,lag),v,lag,None) for v in variables for lag in range(n-1,-1,-1)]
+    for v,kernel,hours in kernel_specs(kernels or {},variables):
+        summary = kernel if hours is None else '{}_{:g}h'.format(kernel,hours)
+        rows.append((v + '_' + summary,v,-1,summary))
+    
+    return pd.DataFrame(rows,columns=['name','variable','lag','summary'])
 
-        if (patient['TIME'].max() - patient['TIME'].min()).total_seconds()/3600 < gap: # cannot label patients with stay shorter than the gap
-            count+= 1
 
-        else:
-            ts = []            
-            t = patient['TIME'].max() #initialize t 
-            window = (patient['TIME'].max() - patient['TIME'].min()).total_seconds()/3600 # window to sample from is full window 
+@instrumented('feature_matrix_parallel',rows=lambda a,out: len(a['df']),vectors=lambda a,out: len(a['ids']))
+def _patient_chunks(ids,chunk_size):
+    # rows of the feature vectors per chunk of chunk_size patients
+    codes = pd.factorize(ids)[0]
+    order = np.argsort(codes,kind='stable')
+    bounds = np.searchsorted(codes[order],np.arange(0,codes.max()+1 if len(codes) else 0,chunk_size))
 
-            for i in range(int(window/int_neg)-1): # Make array with timestamps to sample from, making steps of size 'int_neg'
-                ts.append(t)
-                t = t - timedelta(hours=int_neg)
+    return np.split(order,bounds[1:])
 
-            for t in ts: 
 
-                temp = patient[patient['TIME'].dt.date <= t].reset_index(drop=True) # Extract snippet before this day
+@instrumented('feature_matrix_chunked',rows=lambda a,out: len(a['df']),vectors=lambda a,out: len(a['ids']))
+def feature_matrix_chunked(df,df_demo,imputer,ids,cutoffs,n,variables,chunk_size=200,dtype=np.float64,kernels=None):
+    """
+    feature_matrix in chunks of patients in this process, on one sorted copy of the data (see sorted_series), so the 
+    sort and the cumulative sums of the kernels are done once. Every chunk is timed, like the chunks of 
+    feature_matrix_parallel, for the per-patient latency histogram. The result is identical to feature_matrix.
 
-                v,med_share,ff_share,med_spec,ff_spec = create_feature_window(temp,df_train,df_demo,df_demo_train,feature_window,features,idx)
-                neg.append(v)
+    Parameters
+    ----------
+    df, df_demo, imputer, ids, cutoffs, n, variables, dtype, kernels: 
+        see feature_matrix
+    chunk_size: Optional[int]
+        Number of patients per chunk.
 
-    print('number of patients with too little data for feature vector: ', count)            
+    Returns
+    -------
+    X: matrix [N feature vectors x N variables]
+    type : np.array
+    """
+    ids = np.asarray(ids)
+    cutoffs = np.asarray(cutoffs,dtype='datetime64[ns]')
+    series = sorted_series(df,variables)
+    
+    X = np.empty((len(ids),len(df_demo.columns[1:]) + n*len(variables) + len(kernel_specs(kernels or {},variables))),
+                 dtype=dtype)
+    
+    for r in _patient_chunks(ids,chunk_size):
+        start = time.perf_counter()
+        # undecorated, the chunks are recorded by the feature_matrix_chunked stage
+        X[r] = feature_matrix.__wrapped__(df,df_demo,imputer,ids[r],cutoffs[r],n,variables,series=series,dtype=dtype,
+                                          kernels=kernels)
+        n_patients = len(pd.unique(ids[r]))
+        observe('patient_latency_s',[(time.perf_counter() - start)/n_patients]*n_patients) # mean latency per patient of the chunk
+    
+    return X
 
-    pos=np.array([np.array(x) for x in pos])
-    neg=np.array([np.array(x) for x in neg])
-    print('shape of positive class: ', pos.shape, 'shape of negative class: ', neg.shape)
 
-    X = np.concatenate((pos, neg), axis=0)
-    y = np.concatenate((np.ones(pos.shape[0]),np.zeros(neg.shape[0])),axis=0)
+def feature_matrix_parallel(df,df_demo,imputer,ids,cutoffs,n,variables,n_jobs=-1,chunk_size=200,dtype=np.float64,
+                            kernels=None):
+    """
+    feature_matrix, with the patients distributed over a pool of worker processes. The data is sent once to every 
+    worker, a task only contains the IDs and cutoffs of a chunk of patients. The result is identical to feature_matrix.
 
-    print(X.shape)
-    assert(np.isnan(X).any() == False)
-    print(y.shape)
-    assert(np.isnan(y).any() == False)
+    Parameters
+    ----------
+    df, df_demo, imputer, ids, cutoffs, n, variables, dtype, kernels: 
+        see feature_matrix
+    n_jobs: Optional[int]
+        Number of worker processes, -1 for all cores.
+    chunk_size: Optional[int]
+        Number of patients per task.
 
-    return X, y     
-   
+    Returns
+    -------
+    X: matrix [N feature vectors x N variables]
+    type : np.array
+    """
+    import os
+    from concurrent.futures import ProcessPoolExecutor
     
+    if n_jobs < 1:
+        n_jobs = os.cpu_count()
+    
+    ids = np.asarray(ids)
+    cutoffs = np.asarray(cutoffs,dtype='datetime64[ns]')
+    
+    rows = _patient_chunks(ids,chunk_size)
+    X = np.empty((len(ids),len(df_demo.columns[1:]) + n*len(variables) + len(kernel_specs(kernels or {},variables))),
+                 dtype=dtype)
+    
+    with ProcessPoolExecutor(max_workers=n_jobs,initializer=_init_feature_worker,
+                             initargs=(df[df['VARIABLE'].isin(variables)],df_demo,imputer,n,variables,dtype,kernels)) as pool:
+        for r,(X_chunk,elapsed,n_patients) in zip(rows,pool.map(_feature_chunk,[ids[r] for r in rows],[cutoffs[r] for r in rows])):
+            X[r] = X_chunk
+            observe('patient_latency_s',[elapsed/max(n_patients,1)]*n_patients) # mean latency per patient of the chunk
+    
+    return X
+
+
+_worker = {} # data of a worker process of feature_matrix_parallel
+
+def _init_feature_worker(df,df_demo,imputer,n,variables,dtype,kernels=None):
+    
+    df,index = patient_index(df)
+    _worker.update(df=df,index=index,df_demo=df_demo,imputer=imputer,n=n,variables=variables,dtype=dtype,kernels=kernels)
 
+
+def _feature_chunk(ids,cutoffs):
+    # returns the feature vectors of the chunk, the time it took and the number of patients
+    start = time.perf_counter()
+    index = _worker['index']
+    rows = [np.arange(index[i].start,index[i].stop) for i in pd.unique(ids) if i in index]
+    df = _worker['df'].iloc[np.concatenate(rows) if rows else []]
     
-def create_feature_window(df,df_train,df_demo,df_demo_train,n,variables,idx):
+    # undecorated, the chunks are recorded by the feature_matrix_parallel stage of the parent process
+    X = feature_matrix.__wrapped__(df,_worker['df_demo'],_worker['imputer'],ids,cutoffs,_worker['n'],_worker['variables'],
+                                   dtype=_worker['dtype'],kernels=_worker['kernels'])
+
+    return X,time.perf_counter() - start,len(rows)
+
+
+def create_feature_window(df,df_demo,imputer,n,variables,idx):
     """
     Samples feature vectors from the input dfs. 
 
@@ -336,12 +1172,10 @@ def create_feature_window(df,df_train,df_demo,df_demo_train,n,variables,idx):
     ----------
     df : pd.DataFrame
         df with data of inidividual patient until moment of sampling
-    df_train: pd.DataFrame
-        df containing training set. Imputed values are based on the training set. 
     df_demo: pd.DataFrame
-        demograhics df to sample from.
-    df_demo_train: pd.DataFrame
-        demograhics df containing the training set. Imputed values are based on the training set. 
+        demograhics df to sample from, indexed by ID.
+    imputer: Imputer
+        imputation statistics of the training set, see classes.Imputer
     n: int
         feature_window
     variables: np.array[str]
@@ -355,18 +1189,16 @@ def create_feature_window(df,df_train,df_demo,df_demo_train,n,variables,idx):
     type : np.array
     """
     v = list() #define empty feature vector
-        
-    df_demo_train = df_demo_train.dropna()
     
     #Add demographics 
+    demo = df_demo.loc[idx] if idx in df_demo.index else None
+    
     for col in df_demo.columns[1:]:
         
-        ff_spec.append(0)
-        
-        if df_demo.loc[df_demo['ID'] == idx][col].notnull().sum() == 0:
-            v.extend(df_demo_train.loc[:,col].median()*np.ones(1))
+        if demo is None or pd.isnull(demo[col]):
+            v.append(imputer.demo[col])
         else:
-            v.extend(df_demo.loc[df_demo['ID'] == idx][col])
+            v.append(demo[col])
     
     # Add labs / vitals
     
@@ -375,7 +1207,7 @@ def create_feature_window(df,df_train,df_demo,df_demo_train,n,variables,idx):
         temp = df[df['VARIABLE']==item] # Extract snippet with only this feature
         
         if temp.shape[0] < 1: # If snippet contains none for this feature
-            a = np.ones(n)*np.median(df_train[df_train['VARIABLE']==item]['VALUE']) #Impute with median imputer
+            a = np.ones(n)*imputer.values[item] #Impute with statistic of training set
             v.extend(a)
             
         elif temp.shape[0] < n: # If snippet contains less than n values for feature, impute with most recent value
@@ -390,10 +1222,105 @@ def create_feature_window(df,df_train,df_demo,df_demo_train,n,variables,idx):
     return v
 
 
-def balancer(X,y,undersampling=True):
+@instrumented('balance_indices',vectors=lambda a,out: len(a['y']))
+def balance_indices(y,undersampling=True,groups=None,random_state=0):
+    """
+    Rows of a balanced training set, without copying the feature matrix: train on X[indices], y[indices].
+
+    Parameters
+    ----------
+    y: np.array
+        label vector [N feature vectors x 1]
+    undersampling: optional: bool
+        if True, draw as many majority rows as there are minority rows (without replacement). If False, add minority
+        rows drawn with replacement until the classes are equal.
+    groups: optional: np.array
+        patient ID per row. If given, undersampling is stratified by patient: every patient keeps the same share of
+        its majority rows (largest remainder rounding), so patients with many feature vectors do not dominate by chance.
+    random_state: optional: int
+        seed of the random generator
+    
+    Returns
+    -------
+    indices: np.array
+        sorted row numbers, oversampled rows appear more than once
+    """
+    rng = np.random.default_rng(random_state)
+    y = np.asarray(y)
+    classes,counts = np.unique(y,return_counts=True)
+    if len(classes) < 2:
+        return np.arange(len(y))
+    
+    majority = y == classes[np.argmax(counts)]
+    n_min,n_maj = counts.min(),counts.max()
+    
+    if not undersampling:
+        extra = rng.choice(np.flatnonzero(~majority),n_maj - n_min,replace=True)
+        return np.sort(np.concatenate([np.arange(len(y)),extra]))
+    
+    rows = np.flatnonzero(majority)
+    if groups is None:
+        keep = rng.choice(rows,n_min,replace=False)
+    else:
+        g = pd.factorize(np.asarray(groups)[rows])[0]
+        size = np.bincount(g)
+        
+        # number of rows to keep per patient
+        share = size*n_min/n_maj
+        quota = np.floor(share).astype(int)
+        remainder = np.lexsort((rng.random(len(size)),quota - share))
+        quota[remainder[:n_min - quota.sum()]] += 1
+        
+        # random rank of every row within its patient
+        order = np.lexsort((rng.random(len(rows)),g))
+        rank = np.empty(len(rows),dtype=int)
+        rank[order] = np.arange(len(rows)) - np.repeat(np.cumsum(size) - size,size)
+        keep = rows[rank < quota[g]]
+    
+    return np.sort(np.concatenate([np.flatnonzero(~majority),keep]))
+
+
+def balance_weights(y):
+    """
+    Sample weights that balance the classes (n_samples / (n_classes * n_class_samples)), as alternative to resampling.
+    Pass them as sample_weight to train_model.
+
+    Returns
+    -------
+    weights: np.array
+    """
+    classes,inverse,counts = np.unique(np.asarray(y),return_inverse=True,return_counts=True)
+    
+    return len(inverse)/(len(classes)*counts[inverse])
+
+
+def balanced_batches(X,y,indices=None,batch_size=1024,random_state=0):
+    """
+    Shuffled mini-batches of the rows in indices (e.g. from balance_indices), for models with partial_fit:
+    
+        for X_b,y_b in balanced_batches(X,y,balance_indices(y)):
+            clf.partial_fit(X_b,y_b,classes=[0,1])
+    
+    Only one batch is in memory at a time, so X can be a memory-mapped array (see store.load_features).
+
+    Returns
+    -------
+    generator of (X_batch, y_batch)
+    """
+    indices = np.arange(len(y)) if indices is None else np.asarray(indices)
+    indices = np.random.default_rng(random_state).permutation(indices)
+    y = np.asarray(y)
+    
+    for start in range(0,len(indices),batch_size):
+        rows = np.sort(indices[start:start + batch_size]) # read X in order
+        yield X[rows],y[rows]
+
+
+@instrumented('balancer',vectors=lambda a,out: len(a['y']))
+def balancer(X,y,undersampling=True,return_indices=False,random_state=0):
     print('balancer triggered')
     """
-    Balences classes.
+    Balences classes. Makes a copy of X, see balance_indices to train without one.
 
     Parameters
     ----------
@@ -403,6 +1330,10 @@ def balancer(X,y,undersampling=True):
         label vector [N feature vectors x 1]
     undersampling: optional: bool
         if True, use random undersampling. If False, use random oversampling.
+    return_indices: optional: bool
+        if True, also return the rows of X that were sampled, e.g. to select the patient IDs of the balanced set.
+    random_state: optional: int
+        seed of the random generator
     
     Returns
     -------
@@ -412,27 +1343,21 @@ def balancer(X,y,undersampling=True):
         balanced label vector [N feature vectors x 1]
     type : np.array
     """
-    import imblearn
-    from imblearn.under_sampling import RandomUnderSampler
-    from imblearn.over_sampling import RandomOverSampler
-
-    if undersampling:
-        undersample = RandomUnderSampler(sampling_strategy='majority')
-        print('Rebalance classes by random undersampling')
-        X_bal, y_bal = undersample.fit_resample(X, y)
-    else:
-        
-        oversample = RandomOverSampler(sampling_strategy='minority')
-        print('Rebalance classes by random oversampling')
-        X_bal, y_bal = oversample.fit_resample(X, y)
+    print('Rebalance classes by random','undersampling' if undersampling else 'oversampling')
+    indices = balance_indices(y,undersampling,random_state=random_state)
+    X_bal, y_bal = X[indices], np.asarray(y)[indices]
     
     print('After balancing: \n shape X',X_bal.shape,'n pos',sum(y_bal), 'n neg', len(y_bal)-sum(y_bal))
+    
+    if return_indices:
+        return X_bal, y_bal, indices
     return X_bal, y_bal
 
 
 
 
-def train_model(X_train,y_train,X_test,y_test,model):
+@instrumented('train_model',vectors=lambda a,out: len(a['y_train']))
+def train_model(X_train,y_train,X_test,y_test,model,search='grid',budget_s=None,groups=None,sample_weight=None):
     print('train_model triggered')
     
     """
@@ -449,28 +1374,41 @@ def train_model(X_train,y_train,X_test,y_test,model):
     y_test: np.array
         Test set label vector [N feature vectors x 1]
     model: str
-        model type: "LR" or "RF"
+        model type: "LR", "RF" or "HGB" (histogram-based gradient boosting, fast on large matrices). To compare
+        several models, see training.train_models.
+    search: Optional[str]
+        'grid' for an exhaustive GridSearchCV, 'halving' for successive halving over the number of trees with
+        warm-started forests (see halving_search). LR and HGB always use the grid.
+    budget_s: Optional[float]
+        time budget in seconds for the 'halving' search
+    groups: Optional[np.array]
+        patient ID per row of X_train. If given, cross-validation folds keep the feature vectors of a patient 
+        together (see grouped_grid_search), so patients do not leak between folds.
+    sample_weight: Optional[np.array]
+        weight per row of X_train, e.g. from balance_weights, used in every fit
     
     Returns
     -------
     clf_ret: object
-        trained classifier to be returned
+        trained classifier to be returned. After the 'halving' search, its search_report_ holds the report of
+        halving_search (fits per second and search time).
     train_auc: float
         Area under the curve for model's performance on the train set
     explainer: object
-        explainer for Shapley values based on the trained classifier
+        explainer for Shapley values based on the trained classifier, see explain.make_explainer
     """
     
     from sklearn.model_selection import RandomizedSearchCV, GridSearchCV
     from sklearn.linear_model import LogisticRegression
-    from sklearn.ensemble import RandomForestClassifier
-    import shap
+    from sklearn.ensemble import RandomForestClassifier, HistGradientBoostingClassifier
+    from explain import make_explainer
     
+    report = None
     if model == 'RF':
         
         
         n_estimators = [500,600] # Number of trees in random forest
-        max_features = ['auto', 'log2',0.33] # Number of features to consider at every split
+        max_features = ['sqrt', 'log2',0.33] # Number of features to consider at every split ('auto' in older sklearn)
         max_depth = [3,5,7,9,11] # Maximum number of levels in tree, make not to deep to prevent overfitting
         
         param_grid = {'n_estimators': n_estimators,
@@ -486,18 +1424,39 @@ def train_model(X_train,y_train,X_test,y_test,model):
                        'solver': ['liblinear']}
         clf = LogisticRegression(max_iter=1000)
         
-    rf_grid = GridSearchCV(estimator = clf, param_grid = param_grid,
-                                   cv = 10, verbose=0, n_jobs = -1)
-    
-    rf_grid.fit(X_train, y_train)
-    print(rf_grid.best_params_)
+    elif model == 'HGB':
+        
+        param_grid = {'learning_rate':[0.05,0.1],'max_leaf_nodes':[15,31],'l2_regularization':[0,1]}
+        clf = HistGradientBoostingClassifier(max_iter=300,early_stopping=True)
+        
+    else:
+        raise ValueError('unknown model: ' + str(model))
+        
+    if search == 'halving' and model == 'RF':
+        
+        param_grid.pop('n_estimators')
+        best_params,clf_opt,report = halving_search(X_train,y_train,param_grid,max_trees=max(n_estimators),budget_s=budget_s,
+                                                    groups=groups,sample_weight=sample_weight)
+        print(best_params)
+        
+    elif groups is not None:
+        best_params,clf_opt,cv_results = grouped_grid_search(X_train,y_train,groups,clf,param_grid,n_splits=10,
+                                                             sample_weight=sample_weight)
+        print(best_params)
+        
+    else:
+        rf_grid = GridSearchCV(estimator = clf, param_grid = param_grid,
+                                       cv = 10, verbose=0, n_jobs = -1)
+        
+        rf_grid.fit(X_train, y_train, sample_weight=sample_weight)
+        print(rf_grid.best_params_)
+        clf_opt = rf_grid.best_estimator_
     
-    clf.fit(X_train, y_train)
+    clf.fit(X_train, y_train, sample_weight=sample_weight)
     print(clf.classes_)
     print('Performance on test set with unoptimized model:')
     base_auc,_,_,_,_,_,_ = evaluate_metrics(clf, X_test, y_test)
     
-    clf_opt = rf_grid.best_estimator_
     print('Perfromance on test set with optimized model:')
     opt_auc,_,_,_,_,_,_ = evaluate_metrics(clf_opt, X_test,y_test)
     
@@ -509,17 +1468,229 @@ def train_model(X_train,y_train,X_test,y_test,model):
     else:
         clf_ret = clf
 
+    if report is not None:
+        clf_ret.search_report_ = report
+
     train_auc = max(opt_auc,base_auc)
-    explainer = shap.TreeExplainer(clf_ret)
+    explainer = make_explainer(clf_ret,X_train) # TreeExplainer does not work for LR
 
     
     return clf_ret,train_auc,explainer
 
 
+def cv_folds(y,groups=None,n_splits=10,random_state=0):
+    """
+    Stratified cross-validation folds, computed once so they can be shared by all candidates of a search.
+    If groups (patient IDs) are given, all feature vectors of a patient are in the same fold.
+
+    Returns
+    -------
+    folds: list[tuple]
+        (train rows, test rows) per fold
+    """
+    from sklearn.model_selection import StratifiedKFold, StratifiedGroupKFold
+    
+    if groups is None:
+        return list(StratifiedKFold(n_splits=n_splits,shuffle=True,random_state=random_state).split(np.zeros(len(y)),y))
+    
+    return list(StratifiedGroupKFold(n_splits=n_splits,shuffle=True,random_state=random_state).split(np.zeros(len(y)),y,groups))
+
+
+def fold_matrices(X,y,folds,folder):
+    """
+    Writes X once to a memory-mapped .npy file, so parallel workers read the same pages instead of each getting its 
+    own copy of X. The folds are passed on as row numbers, a worker only selects the rows of its own fold.
+
+    Returns
+    -------
+    matrices: list[tuple]
+        (X, y, train rows, test rows) per fold, X as one read-only np.memmap shared by all folds
+    """
+    import os
+    
+    path = os.path.join(folder,'X.npy')
+    out = np.lib.format.open_memmap(path,mode='w+',dtype=X.dtype,shape=X.shape)
+    for start in range(0,X.shape[0],65536):
+        out[start:start + 65536] = X[start:start + 65536]
+    out.flush()
+    del out
+    X = np.load(path,mmap_mode='r')
+    
+    return [(X,y,train,test) for train,test in folds]
+
+
+def _fit_score(clf,X,y,train,test,sample_weight=None):
+    
+    from sklearn.metrics import roc_auc_score
+    
+    clf.fit(X[train],y[train],sample_weight=None if sample_weight is None else sample_weight[train])
+    return roc_auc_score(y[test],clf.predict_proba(X[test])[:,1])
+
+
+@instrumented('grouped_grid_search',vectors=lambda a,out: len(a['y']))
+def grouped_grid_search(X,y,groups,clf,param_grid,n_splits=10,n_jobs=-1,random_state=0,sample_weight=None):
+    """
+    Grid search with patient-grouped cross-validation. The folds are computed once (cv_folds) and X is written once to
+    a memory-mapped file (fold_matrices), shared by all folds, candidates and workers. Candidates are ranked by mean
+    AUC.
+
+    Parameters
+    ----------
+    X: np.array
+        featurematrix [N feature vectors x N variables]
+    y: np.array
+        label vector [N feature vectors x 1]
+    groups: np.array
+        patient ID per row of X
+    clf: object
+        sklearn classifier
+    param_grid: dict
+        parameter grid
+    n_splits: Optional[int]
+        number of folds
+    n_jobs: Optional[int]
+        number of parallel fits, -1 for all cores
+    sample_weight: Optional[np.array]
+        weight per row of X
+
+    Returns
+    -------
+    best_params: dict
+    clf: object
+        clf with best_params, fitted on all data
+    cv_results: pd.DataFrame
+        mean and std of the AUC per candidate
+    """
+    import tempfile
+    import shutil
+    from joblib import Parallel, delayed
+    from sklearn.base import clone
+    from sklearn.model_selection import ParameterGrid
+    
+    folds = cv_folds(y,groups,n_splits,random_state)
+    candidates = list(ParameterGrid(param_grid))
+    
+    folder = tempfile.mkdtemp(prefix='folds_')
+    try:
+        matrices = fold_matrices(np.asarray(X),np.asarray(y),folds,folder)
+        aucs = Parallel(n_jobs=n_jobs)(delayed(_fit_score)(clone(clf).set_params(**p),*m,sample_weight) for p in candidates 
+                                       for m in matrices)
+    finally:
+        shutil.rmtree(folder,ignore_errors=True)
+    
+    aucs = np.array(aucs).reshape(len(candidates),len(matrices))
+    cv_results = pd.DataFrame(candidates)
+    cv_results['mean_auc'] = aucs.mean(axis=1)
+    cv_results['std_auc'] = aucs.std(axis=1)
+    
+    best_params = candidates[int(np.argmax(cv_results['mean_auc']))]
+    
+    return best_params,clone(clf).set_params(**best_params).fit(X,y,sample_weight=sample_weight),cv_results
+
+
+@instrumented('halving_search',vectors=lambda a,out: len(a['y']))
+def halving_search(X,y,param_grid,min_trees=50,max_trees=600,eta=3,cv=3,budget_s=None,tol=0.001,random_state=0,groups=None,
+                   sample_weight=None):
+    """
+    Successive halving for random forests, with the number of trees as resource. All candidates start with min_trees 
+    trees, after every round the best 1/eta of the candidates (by mean cross-validated AUC) continue with eta times 
+    more trees. Forests are grown with warm_start, so every round only fits the new trees.
+    The search stops at max_trees, when the best AUC improves less than tol, or when the time budget is used.
+
+    Parameters
+    ----------
+    X: np.array
+        featurematrix [N feature vectors x N variables]
+    y: np.array
+        label vector [N feature vectors x 1]
+    param_grid: dict
+        grid of RandomForestClassifier parameters other than n_estimators
+    min_trees, max_trees: Optional[int]
+        number of trees in the first and last round
+    eta: Optional[int]
+        factor by which the candidates are reduced and the trees increased every round
+    cv: Optional[int]
+        number of stratified folds
+    budget_s: Optional[float]
+        time budget in seconds, no limit if None
+    tol: Optional[float]
+        minimal improvement of the best AUC per round to continue
+    groups: Optional[np.array]
+        patient ID per row of X, see cv_folds
+    sample_weight: Optional[np.array]
+        weight per row of X
+
+    Returns
+    -------
+    best_params: dict
+    clf: object
+        RandomForestClassifier with best_params, fitted on all data
+    report: dict
+        best AUC, number of rounds, fits, trees per fit, search time and fits per second
+    """
+    from sklearn.model_selection import ParameterGrid
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.metrics import roc_auc_score
+    
+    start = time.perf_counter()
+    folds = cv_folds(y,groups,cv,random_state)
+    candidates = list(ParameterGrid(param_grid))
+    forests = {i:[RandomForestClassifier(warm_start=True,random_state=random_state,n_jobs=-1,**candidates[i]) for _ in folds]
+               for i in range(len(candidates))}
+    
+    n_trees = min_trees
+    n_fits = 0
+    best_auc = -np.inf
+    rounds = 0
+    alive = list(forests)
+    
+    while True:
+        rounds += 1
+        scores = {}
+        for i in alive:
+            if budget_s is not None and time.perf_counter() - start > budget_s and len(scores) > 0:
+                break
+            aucs = []
+            for forest,(train,test) in zip(forests[i],folds):
+                forest.set_params(n_estimators=n_trees)
+                forest.fit(X[train],y[train],sample_weight=None if sample_weight is None else sample_weight[train])
+                aucs.append(roc_auc_score(y[test],forest.predict_proba(X[test])[:,1]))
+                n_fits += 1
+            scores[i] = np.mean(aucs)
+        
+        ranked = sorted(scores,key=scores.get,reverse=True)
+        improvement = scores[ranked[0]] - best_auc
+        best_auc = max(best_auc,scores[ranked[0]])
+        print('round',rounds,':',len(scores),'candidates with',n_trees,'trees, best AUC {:.4f}'.format(scores[ranked[0]]))
+        
+        if n_trees >= max_trees:
+            break
+        if rounds > 1 and improvement < tol:
+            print('AUC plateaued')
+            break
+        if budget_s is not None and time.perf_counter() - start > budget_s:
+            print('time budget used')
+            break
+        
+        alive = ranked[:max(1,len(ranked)//eta)]
+        n_trees = min(n_trees*eta,max_trees)
+    
+    best_params = dict(candidates[ranked[0]],n_estimators=n_trees)
+    clf = RandomForestClassifier(random_state=random_state,n_jobs=-1,**best_params).fit(X,y,sample_weight=sample_weight)
+    
+    search_s = time.perf_counter() - start
+    report = {'best_auc':best_auc,'rounds':rounds,'fits':n_fits,'search_s':search_s,'fits_per_s':n_fits/search_s}
+    print('search: {} fits in {:.1f}s ({:.2f} fits/s)'.format(n_fits,search_s,n_fits/search_s))
+    
+    return best_params,clf,report
+
+
+@instrumented('evaluate_metrics',vectors=lambda a,out: len(a['test_labels']))
 def evaluate_metrics(model, test_features, test_labels):
      
     """
-    Calculates evaluation metrics
+    Calculates evaluation metrics. The model predicts the set once, all metrics come from these predictions 
+    (see Evaluation).
 
     Parameters
     ----------
@@ -547,22 +1718,13 @@ def evaluate_metrics(model, test_features, test_labels):
     recall: np.array
         array with recalls for different threshold values
     """
-    from sklearn.metrics import roc_auc_score
-    from sklearn.metrics import confusion_matrix
-    from sklearn.metrics import precision_recall_curve
-    
-    predictions = model.predict_proba(test_features)[:,1]
-    auc = roc_auc_score(test_labels, predictions)
-    tn, fp, fn, tp = confusion_matrix(test_labels, model.predict(test_features)).ravel()
+    evaluation = evaluate(model, test_features, test_labels)
+    evaluation.Report()
     
-    print('Model Performance:',auc)
-    print('TN:',tn,'FP:',fp,'FN:',fn,'TP:',tp)
-    print('sens:',np.round(tp/(tp+fn),2),'spec:',np.round(tn/(tn+fp),2))
-    print('Recall:',np.round(tp/(tp+fn),2),'Pecision:',np.round(tp/(tp+fp),2))
+    tn, fp, fn, tp = evaluation.Confusion(0.5)
+    precision, recall, thresholds = evaluation.PR()
     
-    precision, recall, thresholds = precision_recall_curve(test_labels, predictions)
-    
-    return auc,tn, fp, fn, tp,precision,recall
+    return evaluation.AUC(),tn, fp, fn, tp,precision,recall
     
 def plot_PR_curve(precision,recall):
     import matplotlib.pyplot as plt
@@ -574,9 +1736,38 @@ def plot_PR_curve(precision,recall):
     plt.savefig('PR_curve')
     
 def plot_roc_curve(clf,X_val,y_val):
-    import matplotlib.pyplot as plt
-    from sklearn import metrics
-    fig = plt.figure()
-    metrics.plot_roc_curve(clf, X_val, y_val)
-    plt.savefig('ROC_curve')
+    
+    evaluate(clf,X_val,y_val).PlotROC('ROC_curve')
 
+
+
+def save_model(path,bundle):
+    """
+    Saves a trained model together with everything needed to build its feature vectors (e.g. the imputation 
+    statistics), so new data can be scored without the train set.
+
+    Parameters
+    ----------
+    path: str
+        file to write to
+    bundle: dict
+        objects to save, e.g. {'clf':clf,'imputer':imputer,'features':features}
+    """
+    import pickle
+    
+    with open(path,'wb') as f:
+        pickle.dump(bundle,f)
+    
+
+def load_model(path):
+    """
+    Loads a model bundle written by save_model.
+
+    Returns
+    -------
+    bundle: dict
+    """
+    import pickle
+    
+    with open(path,'rb') as f:
+        return pickle.load(f)
@@ -0,0 +1,318 @@
+"""
+Stage-level instrumentation of the pipeline. A stage records its wall time, CPU time, peak memory (RSS sampled every
+few ms), the rows and feature vectors it processed and optional latency histograms, and sends the record to the sinks.
+Without sinks the stages do nothing, so the hooks can stay in the code.
+
+Instrumentation can be switched on without editing code with environment variables:
+    PARCHURE_INSTRUMENT=log                 print a line per stage to stderr
+    PARCHURE_INSTRUMENT=json:stages.jsonl   append a JSON line per stage to stages.jsonl
+    PARCHURE_INSTRUMENT=memory              keep the records in memory, see instrument._sinks[0].Frame()
+    PARCHURE_PROFILE=feature_matrix         also profile this stage with cProfile, written to feature_matrix.prof
+                                            (PARCHURE_PROFILER=pyinstrument for the sampling profiler, if installed)
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import functools
+import contextlib
+
+
+class LogSink:
+    """
+    Prints one line per stage.
+    """
+    def __init__(self,stream=sys.stderr):
+        self.stream = stream
+
+    def __call__(self,record):
+        print('[stage] {:<40} wall {:8.3f}s  cpu {:8.3f}s  peak {:8.1f}MB  rows {}  vectors {}'.format(
+              '  '*record['depth'] + record['stage'],record['wall_s'],record['cpu_s'],record['peak_rss_mb'],
+              record['rows'],record['vectors']),file=self.stream)
+
+
+class JSONSink:
+    """
+    Appends one JSON line per stage to a file.
+    """
+    def __init__(self,path):
+        self.path = path
+
+    def __call__(self,record):
+        with open(self.path,'a') as f:
+            f.write(json.dumps(record,default=str) + '\n')
+
+
+class MemorySink:
+    """
+    Keeps the records in memory, see Frame.
+    """
+    def __init__(self):
+        self.records = []
+
+    def __call__(self,record):
+        self.records.append(record)
+
+    def Frame(self):
+        import pandas as pd
+
+        return pd.DataFrame(self.records)
+
+
+_sinks = []         # functions that receive the record of every stage
+_active = []        # records of the running stages of all threads
+_stacks = {}        # thread id -> records of the running stages of the thread, innermost last
+_profile = {'stage':os.environ.get('PARCHURE_PROFILE'),'profiler':os.environ.get('PARCHURE_PROFILER','cprofile')}
+_lock = threading.Lock()
+_sampler = None
+
+
+def add_sink(sink):
+    """
+    Adds a sink (LogSink, JSONSink, MemorySink or any function of a record dict) and switches instrumentation on.
+    """
+    _sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+
+    _sinks.remove(sink)
+
+
+def enabled():
+
+    return len(_sinks) > 0
+
+
+def profile_stage(name,profiler='cprofile'):
+    """
+    Profiles every run of the stage with this name ('cprofile' or 'pyinstrument'). The profile is written to
+    <name>.prof (cProfile) or <name>.html (pyinstrument), its path is in the record of the stage. None switches it off.
+    """
+    _profile.update(stage=name,profiler=profiler)
+
+
+def rss_mb():
+    """
+    Current resident memory of this process in MB (peak so far if /proc is not available).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/1024**2
+    except (OSError,ValueError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss/1024**2 if sys.platform == 'darwin' else rss/1024
+
+
+def _sample(interval):
+    # updates the peak memory of the running stages
+    while True:
+        time.sleep(interval)
+        rss = rss_mb()
+        with _lock:
+            for record in _active:
+                record['peak_rss_mb'] = max(record['peak_rss_mb'],rss)
+
+
+def _stack():
+    # running stages of this thread; a thread without stages runs inside the innermost stage of the main thread
+    stack = _stacks.get(threading.get_ident())
+    if stack:
+        return stack
+    return _stacks.get(threading.main_thread().ident) or []
+
+
+def _start_sampler(interval=0.005):
+    global _sampler
+    if _sampler is None:
+        _sampler = threading.Thread(target=_sample,args=(interval,),daemon=True)
+        _sampler.start()
+
+
+class Histogram:
+    """
+    Counts of values (e.g. latencies in seconds) in logarithmic bins from 1 microsecond to 100 seconds.
+    """
+    edges = [10**(e/4) for e in range(-24,9)]
+
+    def __init__(self):
+        self.counts = [0]*(len(self.edges) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def Add(self,values):
+        import bisect
+
+        for v in values:
+            self.counts[bisect.bisect_right(self.edges,v)] += 1
+            self.n += 1
+            self.total += v
+            self.max = max(self.max,v)
+
+    def Quantile(self,q):
+        # upper edge of the bin that contains quantile q
+        target,seen = q*self.n,0
+        for edge,count in zip(self.edges + [float('inf')],self.counts):
+            seen += count
+            if seen >= target and count > 0:
+                return min(edge,self.max)
+        return self.max
+
+    def Summary(self):
+
+        return {'n':self.n,'mean':self.total/self.n if self.n else None,'p50':self.Quantile(0.5),
+                'p90':self.Quantile(0.9),'p99':self.Quantile(0.99),'max':self.max,
+                'bins':{'{:.0e}'.format(e):c for e,c in zip(self.edges + [float('inf')],self.counts) if c}}
+
+
+def observe(name,values):
+    """
+    Adds values (e.g. per-patient latencies in seconds) to histogram name of the innermost running stage.
+    """
+    stack = _stack()
+    if not stack:
+        return
+    histograms = stack[-1].setdefault('_histograms',{})
+    histograms.setdefault(name,Histogram()).Add(values)
+
+
+def count(rows=None,vectors=None):
+    """
+    Sets the number of rows and/or feature vectors processed by the innermost running stage.
+    """
+    stack = _stack()
+    if not stack:
+        return
+    if rows is not None:
+        stack[-1]['rows'] = int(rows)
+    if vectors is not None:
+        stack[-1]['vectors'] = int(vectors)
+
+
+@contextlib.contextmanager
+def stage(name,rows=None,vectors=None):
+    """
+    Instruments a block of code. Stages nest, a stage started in a thread without stages of its own runs inside the
+    innermost stage of the main thread. cpu_s is the CPU time of the whole process.
+
+        with stage('sampling_plan'):
+            ...
+            count(vectors=len(plan))
+    """
+    if not _sinks and _profile['stage'] != name:
+        yield None
+        return
+
+    _start_sampler()
+    outer = _stack()
+    record = {'stage':name,'parent':outer[-1]['stage'] if outer else None,'depth':len(outer),
+              'thread':threading.get_ident(),'start':time.time(),'rows':rows,'vectors':vectors,
+              'peak_rss_mb':rss_mb(),'rss_start_mb':rss_mb()}
+    with _lock:
+        _active.append(record)
+        _stacks.setdefault(threading.get_ident(),list(outer)).append(record)
+
+    profiler = None
+    if _profile['stage'] == name:
+        if _profile['profiler'] == 'pyinstrument':
+            import pyinstrument
+            profiler = pyinstrument.Profiler()
+            profiler.start()
+        else:
+            import cProfile
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError: # the same stage is already profiled in another thread
+                profiler = None
+
+    wall,cpu = time.perf_counter(),time.process_time()
+    try:
+        yield record
+    finally:
+        record['wall_s'] = time.perf_counter() - wall
+        record['cpu_s'] = time.process_time() - cpu
+
+        if profiler is not None:
+            if _profile['profiler'] == 'pyinstrument':
+                profiler.stop()
+                record['profile'] = name + '.html'
+                with open(record['profile'],'w') as f:
+                    f.write(profiler.output_html())
+            else:
+                profiler.disable()
+                record['profile'] = name + '.prof'
+                profiler.dump_stats(record['profile'])
+
+        with _lock:
+            _active.remove(record)
+            stack = _stacks[record['thread']]
+            stack.remove(record)
+            if not any(r['thread'] == record['thread'] for r in stack):
+                del _stacks[record['thread']] # only stages of the main thread are left
+            record['peak_rss_mb'] = max(record['peak_rss_mb'],rss_mb())
+
+        for key in ['rows','vectors']:
+            record[key + '_per_s'] = record[key]/record['wall_s'] if record[key] and record['wall_s'] > 0 else None
+        record['histograms'] = {k:h.Summary() for k,h in record.pop('_histograms',{}).items()}
+
+        for sink in list(_sinks):
+            sink(record)
+
+
+def instrumented(name=None,rows=None,vectors=None):
+    """
+    Decorator that runs a function as a stage. rows and vectors are optional functions of (arguments, output), with
+    arguments a dict of the bound arguments by name, e.g.
+
+        @instrumented('df_preparer',rows=lambda a,out: len(a['df']))
+    """
+    def decorator(fn):
+        import inspect
+
+        signature = inspect.signature(fn)
+        stage_name = name or fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*args,**kwargs):
+            if not _sinks and _profile['stage'] != stage_name:
+                return fn(*args,**kwargs)
+
+            with stage(stage_name) as record:
+                out = fn(*args,**kwargs)
+                if rows is not None or vectors is not None:
+                    bound = signature.bind(*args,**kwargs)
+                    bound.apply_defaults()
+                    for key,f in [('rows',rows),('vectors',vectors)]:
+                        if f is not None and record[key] is None:
+                            try:
+                                record[key] = int(f(bound.arguments,out))
+                            except Exception:
+                                pass
+                return out
+
+        return wrapper
+
+    return decorator
+
+
+def _from_environment():
+
+    setting = os.environ.get('PARCHURE_INSTRUMENT')
+    if not setting:
+        return
+    if setting == 'log':
+        add_sink(LogSink())
+    elif setting == 'memory':
+        add_sink(MemorySink())
+    elif setting.startswith('json:'):
+        add_sink(JSONSink(setting[5:]))
+    else:
+        raise ValueError('unknown PARCHURE_INSTRUMENT: ' + setting)
+
+_from_environment()
@@ -1,11 +1,12 @@
 
 import numpy as np
 import pandas as pd
-from matplotlib import pyplot as plt
 import datetime
 import random
+import sys
 from functions import *
 from classes import *
+from columnar import read_measurements
 
 pred_window = 64
 gap = 20
@@ -16,15 +17,20 @@ val_share = 0.4
 test_share = 0.2
 label_type = 'mortality'
 model = 'RF'
+data_path = sys.argv[1] if len(sys.argv) > 1 else 'data/measurements.parquet' # raw long table, see columnar.write_measurements
+features = None # variables to read and use, all variables in the data if None
 
 print('RESULTS FOR MODEL:',model)
 print('PRED W:',pred_window,'Hours')
 print('FEATURE W:',feature_window, 'samples')
 
 #%%
-parchure = Parchure(inputs=inputs,encoders=encoders)
+df = read_measurements(data_path,variables=features) # only the rows of the features are read
+parchure = Parchure(inputs=None,encoders=None,df=df)
+parchure.features = sorted(df['VARIABLE'].unique()) if features is None else features
 parchure.Prepare(random.randint(0, 10),val_share=val_share) # Train / val  / test split and normalization
 parchure.Build_feature_vectors(pred_window,gap,int_neg,int_pos,feature_window) 
 parchure.Balance(undersampling=True)
 parchure.Train(model=model,balance=True)
 auc,tn, fp, fn, tp = parchure.Evaluate()
+parchure.Export('output') # feature matrices and split assignment as Parquet
@@ -0,0 +1,281 @@
+import sys
+import json
+import time
+import queue
+import threading
+import collections
+import numpy as np
+import pandas as pd
+
+from functions import feature_matrix, normalize, normalize_demo, load_model
+
+
+def request_to_frames(requests,demographics=['AGE','BMI']):
+    """
+    Converts scoring requests to the long format of the raw data.
+
+    Parameters
+    ----------
+    requests: list[dict]
+        One dict per patient: {'ID':..., 'AGE':..., 'BMI':..., 'time': optional moment of prediction,
+        'measurements':[{'TIME':..., 'VARIABLE':..., 'VALUE':...}, ...]}. Without 'time', the moment of prediction
+        is the last measurement. 'measurements' can be empty or missing (e.g. at admission), the feature vector of the
+        patient is then imputed completely.
+
+    Returns
+    -------
+    df: pd.DataFrame
+        measurements, with the position of the request as ID
+    df_demo: pd.DataFrame
+        demographics, indexed by the position of the request
+    cutoffs: np.array[datetime64]
+        moment of prediction per request
+    """
+    rows = [(i,m['TIME'],m['VARIABLE'],m['VALUE']) for i,r in enumerate(requests) for m in r.get('measurements') or []]
+    df = pd.DataFrame(rows,columns=['ID','TIME','VARIABLE','VALUE'])
+    df['ID'] = df['ID'].astype(int)
+    df['TIME'] = pd.to_datetime(df['TIME']).astype('datetime64[ns]')
+    df['VARIABLE'] = df['VARIABLE'].astype(object)
+    df['VALUE'] = df['VALUE'].astype(float)
+
+    df_demo = pd.DataFrame({'ID':np.arange(len(requests))})
+    for col in demographics:
+        df_demo[col] = [r.get(col,np.nan) for r in requests]
+    df_demo[demographics] = df_demo[demographics].astype(float)
+
+    last = df.groupby('ID')['TIME'].max().reindex(df_demo['ID'])
+    cutoffs = [pd.Timestamp(r['time']) if r.get('time') is not None else last.iloc[i] for i,r in enumerate(requests)]
+    cutoffs = pd.to_datetime(pd.Series(cutoffs,dtype=object)).fillna(pd.Timestamp.max).values.astype('datetime64[ns]')
+
+    return df,df_demo,cutoffs
+
+
+def score(bundle,requests):
+    """
+    Computes the risk of the outcome for a batch of patients with a model bundle saved by Parchure.Save.
+    The feature vectors have the layout of create_feature_window.
+
+    Parameters
+    ----------
+    bundle: dict
+        see Parchure.Save and load_model
+    requests: list[dict]
+        see request_to_frames
+
+    Returns
+    -------
+    risk: np.array
+        predicted probability of the outcome per request
+    """
+    df,df_demo,cutoffs = request_to_frames(requests)
+
+    if bundle.get('scaler_table') is not None:
+        df = normalize(df,bundle['scaler_table'])
+        df_demo = normalize_demo(df_demo,bundle['scaler_table'])
+    df_demo.index = df_demo['ID'].values
+
+    X = feature_matrix(df,df_demo,bundle['imputer'],df_demo['ID'].values,cutoffs,bundle['feature_window'],bundle['features'],
+                       kernels=bundle.get('kernels'))
+
+    return bundle['clf'].predict_proba(X)[:,1]
+
+
+class Scorer:
+    """
+    Scores requests one by one from any number of threads, but sends them to the model in micro-batches: a batch is
+    scored when it has max_batch requests, or max_wait_ms after its first request. The latency of the last history
+    requests is kept, see Stats. If a batch fails, its requests are scored one by one, so only the bad ones fail.
+
+    Parameters
+    ----------
+    bundle: dict or str
+        model bundle or path to it, see Parchure.Save
+    max_batch: Optional[int]
+        maximum number of requests per batch
+    max_wait_ms: Optional[float]
+        maximum time a request waits for other requests
+    latency_budget_ms: Optional[tuple]
+        (p50, p99) budget in ms, checked by Stats
+    history: Optional[int]
+        number of most recent requests and batches the statistics are computed on
+    """
+    def __init__(self,bundle,max_batch=64,max_wait_ms=5,latency_budget_ms=(50,200),history=10000):
+        self.bundle = load_model(bundle) if isinstance(bundle,str) else bundle     # model bundle
+        self.max_batch = max_batch                  # maximum number of requests per batch
+        self.max_wait = max_wait_ms/1000            # maximum waiting time in seconds
+        self.latency_budget_ms = latency_budget_ms  # (p50, p99) budget
+        self.latencies = collections.deque(maxlen=history)  # latency per recent request in seconds
+        self.batch_sizes = collections.deque(maxlen=history) # number of requests per recent batch
+        self.requests = 0                           # number of requests scored
+        self.admission_risk = float(score(self.bundle,[{}])[0]) # risk of a patient without measurements, scored once so a
+                                                                # bundle that cannot score admissions fails at start
+        self.queue = queue.Queue()                  # waiting requests
+        self.worker = threading.Thread(target=self._run,daemon=True)
+        self.worker.start()
+
+    def _run(self):
+
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get(timeout=max(0,deadline - time.perf_counter())))
+                except queue.Empty:
+                    break
+
+            try:
+                risks = score(self.bundle,[request for request,_,_ in batch])
+                results = [(float(r),None) for r in risks]
+            except Exception:
+                results = [self._score_one(request) for request,_,_ in batch]
+
+            done = time.perf_counter()
+            self.requests += len(batch)
+            self.batch_sizes.append(len(batch))
+            for (_,start,slot),result in zip(batch,results):
+                self.latencies.append(done - start)
+                slot['result'] = result
+                slot['event'].set()
+
+    def _score_one(self,request):
+        # (risk, None) or (None, error) of a single request
+        try:
+            return float(score(self.bundle,[request])[0]),None
+        except Exception as e:
+            return None,e
+
+    def Submit(self,request):
+        """
+        Queues one patient for scoring, see request_to_frames for the request format.
+
+        Returns
+        -------
+        slot: dict
+            to be passed to Result
+        """
+        slot = {'event':threading.Event()}
+        self.queue.put((request,time.perf_counter(),slot))
+        return slot
+
+    def Result(self,slot):
+        """
+        Waits until a request from Submit is scored.
+
+        Returns
+        -------
+        risk: float
+        """
+        slot['event'].wait()
+
+        risk,error = slot['result']
+        if error is not None:
+            raise error
+        return risk
+
+    def Score(self,request):
+        """
+        Scores one patient, blocks until its batch is scored.
+
+        Returns
+        -------
+        risk: float
+        """
+        return self.Result(self.Submit(request))
+
+    def Stats(self):
+        """
+        Latency statistics of the most recent requests (see history).
+
+        Returns
+        -------
+        stats: dict
+            number of requests scored so far, mean batch size, p50 and p99 latency in ms and whether they are within 
+            the budget
+        """
+        latencies = np.array(self.latencies)*1000
+        if len(latencies) == 0:
+            return {'requests':0}
+
+        p50,p99 = np.percentile(latencies,[50,99])
+
+        return {'requests':self.requests,'mean_batch':float(np.mean(self.batch_sizes)),'p50_ms':float(p50),
+                'p99_ms':float(p99),'within_budget':bool(p50 <= self.latency_budget_ms[0] and p99 <= self.latency_budget_ms[1])}
+
+
+def serve_stdin(scorer,stdin=sys.stdin,stdout=sys.stdout):
+    """
+    Reads one JSON request per line from stdin and writes {'risk':...} or {'error':...} per line to stdout.
+    """
+    for line in stdin:
+        if not line.strip():
+            continue
+        try:
+            out = {'risk':scorer.Score(json.loads(line))}
+        except Exception as e:
+            out = {'error':str(e)}
+        stdout.write(json.dumps(out) + '\n')
+        stdout.flush()
+
+
+def serve_http(scorer,host='127.0.0.1',port=8000):
+    """
+    Local HTTP server. POST /score with a JSON request (or a list of requests) returns {'risk':...},
+    GET /stats returns Scorer.Stats. Every request is handled in its own thread, so concurrent requests are batched.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def reply(self,code,body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type','application/json')
+            self.send_header('Content-Length',str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self.reply(200,scorer.Stats())
+            else:
+                self.reply(404,{'error':'not found'})
+
+        def do_POST(self):
+            if self.path != '/score':
+                return self.reply(404,{'error':'not found'})
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length',0))))
+                if isinstance(request,list):
+                    slots = [scorer.Submit(r) for r in request]
+                    self.reply(200,{'risk':[scorer.Result(slot) for slot in slots]})
+                else:
+                    self.reply(200,{'risk':scorer.Score(request)})
+            except Exception as e:
+                self.reply(400,{'error':str(e)})
+
+        def log_message(self,*args):
+            pass
+
+    server = ThreadingHTTPServer((host,port),Handler)
+    print('scoring on http://{}:{}/score'.format(host,port),file=sys.stderr)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Score patients with a model saved by Parchure.Save')
+    parser.add_argument('model',help='path to the model bundle')
+    parser.add_argument('--http',type=int,default=None,help='port for the HTTP server, read stdin if not given')
+    parser.add_argument('--max-batch',type=int,default=64)
+    parser.add_argument('--max-wait-ms',type=float,default=5)
+    args = parser.parse_args()
+
+    scorer = Scorer(args.model,max_batch=args.max_batch,max_wait_ms=args.max_wait_ms)
+
+    if args.http is None:
+        serve_stdin(scorer)
+        print(json.dumps(scorer.Stats()),file=sys.stderr)
+    else:
+        serve_http(scorer,port=args.http)
@@ -0,0 +1,98 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+def data_version(df):
+    """
+    Hash of the content of a df, to be used as data version in feature_key.
+
+    Returns
+    -------
+    version: str
+    """
+    h = pd.util.hash_pandas_object(df,index=False).values
+
+    return hashlib.sha1(h.tobytes()).hexdigest()[:16]
+
+
+def feature_key(data_version,random_state,pred_window,gap,int_neg,int_pos,feature_window,features,label_type,**kwargs):
+    """
+    Key of a set of feature matrices in the feature store. Any setting that changes the feature vectors should be
+    part of the key, extra settings (e.g. val_share, imputation) can be given as keyword arguments.
+
+    Returns
+    -------
+    key: str
+    """
+    config = dict(data_version=data_version,random_state=random_state,pred_window=pred_window,gap=gap,
+                  int_neg=int_neg,int_pos=int_pos,feature_window=feature_window,features=list(features),
+                  label_type=label_type,**kwargs)
+
+    return hashlib.sha1(json.dumps(config,sort_keys=True,default=str).encode()).hexdigest()[:16]
+
+
+def save_features(root,key,arrays,config=None):
+    """
+    Writes arrays to the feature store as .npy files, which can be loaded memory-mapped by load_features.
+    The files are preallocated with open_memmap and the entry only appears in the store when all arrays are written.
+
+    Parameters
+    ----------
+    root: str
+        directory of the feature store
+    key: str
+        see feature_key
+    arrays: dict
+        name -> np.array, e.g. {'X_train':X_train,'y_train':y_train,'ids_train':ids,'times_train':times}.
+        Object arrays (e.g. string IDs) are stored as fixed-width strings.
+    config: Optional[dict]
+        settings the key is based on, written to meta.json
+    """
+    folder = os.path.join(root,key)
+    tmp = folder + '.tmp'
+    shutil.rmtree(tmp,ignore_errors=True)
+    os.makedirs(tmp)
+
+    for name,a in arrays.items():
+        a = np.asarray(a)
+        if a.dtype == object:
+            a = a.astype(str)
+
+        out = np.lib.format.open_memmap(os.path.join(tmp,name + '.npy'),mode='w+',dtype=a.dtype,shape=a.shape)
+        out[...] = a
+        out.flush()
+        del out
+
+    with open(os.path.join(tmp,'meta.json'),'w') as f:
+        json.dump({'key':key,'config':config,'arrays':list(arrays)},f,default=str,indent=1)
+
+    shutil.rmtree(folder,ignore_errors=True)
+    os.rename(tmp,folder)
+
+    print('features saved to',folder)
+
+
+def load_features(root,key):
+    """
+    Loads an entry of the feature store as read-only memory-mapped arrays (no copy of the data is made).
+
+    Returns
+    -------
+    arrays: dict
+        name -> np.memmap, or None if the key is not in the store
+    """
+    folder = os.path.join(root,key)
+
+    if not os.path.exists(os.path.join(folder,'meta.json')):
+        return None
+
+    with open(os.path.join(folder,'meta.json')) as f:
+        names = json.load(f)['arrays']
+
+    print('features loaded from',folder)
+
+    return {name:np.load(os.path.join(folder,name + '.npy'),mmap_mode='r') for name in names}
@@ -0,0 +1,266 @@
+import os
+import numpy as np
+import pandas as pd
+
+from functions import split_ids, patient_index, demographics, normalize, normalize_demo, prepare_feature_vectors, save_model
+from classes import Imputer
+
+
+def read_chunks(path,chunksize=1000000,columns=None):
+    """
+    Reads raw long-format data from a CSV or Parquet file in chunks that contain complete patients.
+    The rows of a patient should be contiguous in the file (e.g. sorted by ID), a ValueError is raised otherwise.
+
+    Parameters
+    ----------
+    path: str
+        .csv or .parquet file with the columns ['ID','BMI','AGE','DEST','DEPARTMENT','TIME','VARIABLE','VALUE']
+    chunksize: Optional[int]
+        Number of rows to read at once. A chunk holds at most chunksize rows plus the rows of one patient.
+    columns: Optional[list[str]]
+        Columns to read, all if None.
+
+    Returns
+    -------
+    generator of pd.DataFrame
+    """
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        reader = (batch.to_pandas() for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize,columns=columns))
+    else:
+        reader = pd.read_csv(path,chunksize=chunksize,usecols=columns)
+
+    seen = set() # patients of earlier chunks
+    carry = None # rows of the last patient of the previous chunk, which may continue in this chunk
+
+    def complete(chunk):
+        ids = pd.unique(chunk['ID'])
+        if not seen.isdisjoint(ids):
+            raise ValueError(path + ' is not grouped by patient, sort it by ID first')
+        seen.update(ids)
+        if 'TIME' in chunk.columns:
+            chunk = chunk.assign(TIME=pd.to_datetime(chunk['TIME']))
+        return chunk
+
+    for chunk in reader:
+        if carry is not None:
+            chunk = pd.concat([carry,chunk])
+
+        ids = chunk['ID'].values
+        last = np.flatnonzero(ids != ids[-1])
+        start = last[-1] + 1 if len(last) else 0 # first row of the trailing patient
+
+        carry = chunk.iloc[start:]
+        if start > 0:
+            yield complete(chunk.iloc[:start])
+
+    if carry is not None and carry.shape[0] > 0:
+        yield complete(carry)
+
+
+def _reservoir(sample,vals,seen,size,rng):
+    # Algorithm R over a batch: sample is a uniform sample of at most size of the seen values before vals
+    fill = max(0,min(size - len(sample),len(vals)))
+    sample = np.concatenate([sample,vals[:fill]])
+    rest = vals[fill:]
+    if len(rest) > 0:
+        j = rng.integers(0,seen + fill + np.arange(1,len(rest) + 1))
+        keep = j < size
+        sample[j[keep]] = rest[keep]
+
+    return sample
+
+
+def fit_streaming(path,variables,val_share=0.25,test_share=0.2,random_state=0,imputation='median',chunksize=1000000,
+                  demographics_cols=['AGE','BMI'],median_sample=1000000):
+    """
+    First pass of the streaming pipeline: splits the patients and computes the normalization and imputation statistics
+    of the train set. The split is identical to df_preparer with the same arguments.
+
+    Only the demographics (one row per patient) are kept in memory, plus a uniform sample of at most median_sample
+    train values per variable if imputation is 'median'. The median is exact for variables with fewer values, and an
+    estimate from the sample otherwise. The mean and std per variable are combined over the chunks, so they can differ
+    from fit_scaler_table by rounding.
+
+    Parameters
+    ----------
+    path: str
+        .csv or .parquet file, see read_chunks
+    variables: np.array[str]
+        Array with strings representing the variable names to be included in the model (excluding demographics).
+    val_share, test_share, random_state:
+        see df_preparer
+    imputation: Optional[str]
+        strategy of the Imputer: 'median', 'mean' or 'last'
+    chunksize: Optional[int]
+        see read_chunks
+    median_sample: Optional[int]
+        maximum number of train values per variable kept for the median
+
+    Returns
+    -------
+    split: pd.Series
+        'train', 'val' or 'test' per patient ID
+    scaler_table: pd.DataFrame
+        see fit_scaler_table
+    imputer: Imputer
+        imputation statistics of the normalized train set
+    """
+    print('fit_streaming triggered')
+
+    # Pass over the IDs only, to split the patients
+    ids = np.unique(np.concatenate([pd.unique(chunk['ID']) for chunk in read_chunks(path,chunksize,columns=['ID'])]))
+    ids_train,ids_val,ids_test = split_ids(ids,val_share,test_share,random_state)
+
+    split = pd.concat([pd.Series('train',index=ids_train),pd.Series('val',index=ids_val),pd.Series('test',index=ids_test)])
+
+    # Pass over the data, with statistics per variable combined over the chunks
+    n = pd.Series(0.0,index=variables)
+    mean = pd.Series(0.0,index=variables)
+    m2 = pd.Series(0.0,index=variables)
+    last_time = pd.Series(pd.NaT,index=variables,dtype='datetime64[ns]')
+    last_value = pd.Series(np.nan,index=variables)
+    values = {v:np.empty(0) for v in variables}
+    rng = np.random.default_rng(random_state)
+    demo = []
+
+    for chunk in read_chunks(path,chunksize):
+        chunk,index = patient_index(chunk)
+        demo.append(demographics(chunk,index))
+
+        train = chunk[chunk['ID'].isin(ids_train) & chunk['VARIABLE'].isin(variables)]
+        grouped = train.groupby('VARIABLE')['VALUE']
+
+        n_b = grouped.count().reindex(variables,fill_value=0)
+        mean_b = grouped.mean().reindex(variables,fill_value=0)
+        m2_b = (grouped.var(ddof=0)*grouped.count()).reindex(variables,fill_value=0)
+
+        # combine mean and sum of squared deviations of two batches (Chan et al.)
+        total = n + n_b
+        delta = mean_b - mean
+        mean = mean + (delta*n_b/total).fillna(0)
+        m2 = m2 + m2_b + (delta**2*n*n_b/total).fillna(0)
+        n = total
+
+        if imputation == 'last':
+            latest = train.sort_values('TIME',kind='mergesort').groupby('VARIABLE').last().reindex(variables)
+            newer = latest['TIME'] >= last_time.fillna(pd.Timestamp.min)
+            last_time[newer] = latest.loc[newer,'TIME']
+            last_value[newer] = latest.loc[newer,'VALUE']
+        elif imputation == 'median':
+            for v,vals in grouped:
+                vals = vals.dropna().values
+                values[v] = _reservoir(values[v],vals,int(n[v]) - len(vals),median_sample,rng)
+
+    df_demo = pd.concat(demo)
+    df_demo_train = df_demo[df_demo['ID'].isin(ids_train)]
+
+    found = n > 0
+    for v in n.index[~found]:
+        print(v,'not in training set')
+
+    std = np.sqrt(m2[found]/n[found])
+    scaler_table = pd.concat([pd.DataFrame({'mean':mean[found],'std':std}),
+                              pd.DataFrame({'mean':df_demo_train[demographics_cols].mean(),
+                                            'std':df_demo_train[demographics_cols].std(ddof=0)})])
+    scaler_table.loc[~(scaler_table['std'] > 0),'std'] = 1.0
+
+    # Imputation statistics, on the normalized scale
+    imputer = Imputer(strategy=imputation)
+    if imputation == 'median':
+        raw = pd.Series({v:np.median(values[v]) for v in variables if len(values[v]) > 0},dtype=float)
+    elif imputation == 'mean':
+        raw = mean[found]
+    elif imputation == 'last':
+        raw = last_value[found]
+    else:
+        raise ValueError('unknown imputation strategy: ' + str(imputation))
+
+    imputer.values = ((raw - scaler_table['mean'])/scaler_table['std']).reindex(variables)
+
+    df_demo_train = normalize_demo(df_demo_train,scaler_table,demographics_cols).dropna().iloc[:,1:]
+    imputer.demo = df_demo_train.mean() if imputation == 'mean' else df_demo_train.median()
+
+    print('patients: train',len(ids_train),'val',len(ids_val),'test',len(ids_test))
+
+    return split,scaler_table,imputer
+
+
+def prepare_feature_vectors_streaming(path,out_dir,features,pred_window,gap,int_neg,int_pos,feature_window,
+                                      val_share=0.25,test_share=0.2,random_state=0,label_type='mortality',
+                                      imputation='median',chunksize=1000000,n_jobs=1):
+    """
+    Builds the feature vectors of a cohort that does not fit in memory. The first pass (fit_streaming) splits the
+    patients and fits the normalization and imputation. The second pass builds the feature vectors chunk by chunk
+    with prepare_feature_vectors, and writes them to out_dir/<split>/part-<i>.npz. Peak memory depends on chunksize,
+    not on the size of the cohort.
+
+    Parameters
+    ----------
+    path: str
+        .csv or .parquet file, see read_chunks
+    out_dir: str
+        directory for the feature vectors. The scaler table and imputer are saved to out_dir/preprocessing.pkl.
+    features, pred_window, gap, int_neg, int_pos, feature_window, label_type, n_jobs:
+        see prepare_feature_vectors
+    val_share, test_share, random_state:
+        see df_preparer
+    imputation: Optional[str]
+        strategy of the Imputer: 'median', 'mean' or 'last'
+    chunksize: Optional[int]
+        see read_chunks
+
+    Returns
+    -------
+    counts: pd.DataFrame
+        number of feature vectors and positive feature vectors per split
+    """
+    print('prepare_feature_vectors_streaming triggered')
+
+    split,scaler_table,imputer = fit_streaming(path,features,val_share,test_share,random_state,imputation,chunksize)
+
+    os.makedirs(out_dir,exist_ok=True)
+    save_model(os.path.join(out_dir,'preprocessing.pkl'),{'scaler_table':scaler_table,'imputer':imputer,'features':features})
+
+    counts = pd.DataFrame(0,index=['train','val','test'],columns=['vectors','positive'])
+
+    for i,chunk in enumerate(read_chunks(path,chunksize)):
+        chunk,index = patient_index(chunk)
+        df_demo = normalize_demo(demographics(chunk,index),scaler_table)
+        chunk = normalize(chunk,scaler_table)
+        chunk_split = chunk['ID'].map(split)
+
+        for name in counts.index:
+            df = chunk[chunk_split == name]
+            if df.shape[0] == 0:
+                continue
+
+            X,y = prepare_feature_vectors(df,df_demo[df_demo['ID'].isin(df['ID'])],imputer,pred_window,gap,int_neg,int_pos,
+                                          feature_window,features,label_type=label_type,n_jobs=n_jobs)
+
+            os.makedirs(os.path.join(out_dir,name),exist_ok=True)
+            np.savez(os.path.join(out_dir,name,'part-{:05d}.npz'.format(i)),X=X,y=y)
+
+            counts.loc[name,'vectors'] += len(y)
+            counts.loc[name,'positive'] += int(y.sum())
+
+    print(counts)
+
+    return counts
+
+
+def load_feature_parts(out_dir,split='train'):
+    """
+    Loads the feature vectors of one split written by prepare_feature_vectors_streaming.
+
+    Returns
+    -------
+    X: matrix [N feature vectors x N variables]
+    y: vector [N feature vectors x 1]
+    type : np.array
+    """
+    folder = os.path.join(out_dir,split)
+    parts = [np.load(os.path.join(folder,f)) for f in sorted(os.listdir(folder)) if f.endswith('.npz')]
+
+    return np.concatenate([p['X'] for p in parts]),np.concatenate([p['y'] for p in parts])
@@ -0,0 +1,150 @@
+import time
+import itertools
+import numpy as np
+import pandas as pd
+
+from functions import split_on_label, sorted_series, sampling_plan, feature_matrix, balance_indices
+from evaluation import evaluate
+
+
+def config_grid(pred_window,gap,int_neg,int_pos,feature_window):
+    """
+    All combinations of the given values, e.g. config_grid([24,64],[20],[4,8],[4],[1,3]).
+
+    Returns
+    -------
+    configs: list[dict]
+    """
+    names = ['pred_window','gap','int_neg','int_pos','feature_window']
+
+    return [dict(zip(names,values)) for values in itertools.product(pred_window,gap,int_neg,int_pos,feature_window)]
+
+
+def prepare_sweep(parchure,label_type='mortality'):
+    """
+    Everything that does not depend on the window settings, computed once: the data of positive and negative
+    patients and the sorted series (see sorted_series) of the training and validation set.
+
+    Parameters
+    ----------
+    parchure: Parchure
+        object on which Prepare has been run
+
+    Returns
+    -------
+    state: dict
+    """
+    events = parchure.Events(label_type)
+    state = {'imputer':parchure.imputer,'features':parchure.features,'label_type':label_type,'events':events}
+
+    for name,df,df_demo in [('train',parchure.df_train,parchure.df_demo_train),('val',parchure.df_val,parchure.df_demo_val)]:
+        df_pos,df_neg = split_on_label(df,label_type,events)
+        state[name] = {'df_pos':df_pos,'df_neg':df_neg,'df_demo':df_demo,'series':sorted_series(df,parchure.features)}
+
+    return state
+
+
+def run_config(state,config,clf=None,balance=True):
+    """
+    Builds the feature vectors of one window configuration from a prepared state, trains clf on the training set and
+    evaluates it on the validation set.
+
+    Returns
+    -------
+    result: dict
+        the configuration, number of feature vectors, AUC, confusion counts (threshold 0.5) and timings in seconds
+    """
+    from sklearn.base import clone
+    from sklearn.ensemble import RandomForestClassifier
+
+    result = dict(config)
+    data = {}
+
+    t = time.perf_counter()
+    for name in ['train','val']:
+        s = state[name]
+        plan,_ = sampling_plan(s['df_pos'],s['df_neg'],config['pred_window'],config['gap'],config['int_neg'],
+                               config['int_pos'],state['label_type'],events=state['events'])
+        X = feature_matrix(None,s['df_demo'],state['imputer'],plan['ID'].values,plan['CUTOFF'].values,
+                           config['feature_window'],state['features'],series=s['series'])
+        data[name] = (X,plan['LABEL'].values.astype(float))
+        result['n_' + name] = len(plan)
+    result['build_s'] = time.perf_counter() - t
+
+    X_train,y_train = data['train']
+    X_val,y_val = data['val']
+    if len(np.unique(y_train)) < 2 or len(np.unique(y_val)) < 2:
+        print('only one class for',config)
+        return result
+
+    t = time.perf_counter()
+    if balance:
+        rows = balance_indices(y_train)
+        X_train,y_train = X_train[rows],y_train[rows]
+    model = clone(clf) if clf is not None else RandomForestClassifier(random_state=0)
+    model.fit(X_train,y_train)
+    result['train_s'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    evaluation = evaluate(model,X_val,y_val)
+    result['auc'] = evaluation.AUC()
+    result['tn'],result['fp'],result['fn'],result['tp'] = evaluation.Confusion(0.5)
+    result['eval_s'] = time.perf_counter() - t
+
+    return result
+
+
+_state = {} # prepared state of a worker process
+
+def _init_sweep_worker(state,clf,balance):
+
+    _state.update(state=state,clf=clf,balance=balance)
+
+
+def _run_config(config):
+
+    return run_config(_state['state'],config,_state['clf'],_state['balance'])
+
+
+def run_sweep(parchure,configs,clf=None,label_type='mortality',balance=True,n_jobs=1):
+    """
+    Backtests many window configurations. The data is prepared once (prepare_sweep); per configuration only the
+    sample timestamps and window lookups are computed, after which a model is trained and evaluated (run_config).
+
+    Parameters
+    ----------
+    parchure: Parchure
+        object on which Prepare has been run
+    configs: list[dict]
+        dicts with pred_window, gap, int_neg, int_pos and feature_window, see config_grid
+    clf: Optional[object]
+        sklearn classifier, cloned for every configuration. Default: RandomForestClassifier(random_state=0)
+    label_type: Optional[str]
+        'mortality' or 'ICU'
+    balance: Optional[bool]
+        if True, undersample the training set (balance_indices)
+    n_jobs: Optional[int]
+        number of worker processes, -1 for all cores. The prepared data is sent once to every worker.
+
+    Returns
+    -------
+    results: pd.DataFrame
+        one row per configuration, see run_config
+    """
+    import os
+    from concurrent.futures import ProcessPoolExecutor
+
+    print('run_sweep triggered:',len(configs),'configurations')
+
+    t = time.perf_counter()
+    state = prepare_sweep(parchure,label_type)
+    print('data prepared in {:.2f}s'.format(time.perf_counter() - t))
+
+    if n_jobs == 1:
+        results = [run_config(state,config,clf,balance) for config in configs]
+    else:
+        n_jobs = os.cpu_count() if n_jobs < 1 else n_jobs
+        with ProcessPoolExecutor(max_workers=n_jobs,initializer=_init_sweep_worker,initargs=(state,clf,balance)) as pool:
+            results = list(pool.map(_run_config,configs))
+
+    return pd.DataFrame(results)
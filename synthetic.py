@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+
+
+# mean, std and measurements per hour of the default synthetic variables
+DEFAULT_VARIABLES = {'HR':(85,15,1/2),
+                     'RR':(20,5,1/2),
+                     'SpO2':(95,3,1/2),
+                     'Temp':(37.2,0.8,1/4),
+                     'CRP':(80,60,1/24),
+                     'LDH':(300,120,1/24),
+                     'Ddimer':(1.5,1.2,1/24)}
+
+
+def make_cohort(n_patients=1000,stay_hours=120,frequency=1.0,missingness=0.1,variables=None,mortality=0.15,icu=0.2,
+                effect=1.5,start='2020-03-01',random_state=0,categorical=False):
+    """
+    Generates a synthetic cohort in the long format of the raw data (columns ['ID','BMI','AGE','DEST','DEPARTMENT',
+    'TIME','VARIABLE','VALUE']), to reproduce and benchmark the pipeline without patient data. All patients are
+    generated at once with numpy, so 100k patients take seconds.
+
+    Patients who die drift away from the mean in the hours before death, so models can learn something.
+
+    Parameters
+    ----------
+    n_patients: Optional[int]
+        number of patients
+    stay_hours: Optional[float]
+        mean length of stay in hours (exponential, at least 6 hours)
+    frequency: Optional[float]
+        multiplier of the measurement frequency of all variables
+    missingness: Optional[float]
+        probability that a variable is never measured for a patient, and that BMI is missing
+    variables: Optional[dict]
+        name -> (mean, std, measurements per hour), DEFAULT_VARIABLES if None
+    mortality: Optional[float]
+        fraction of patients who die (DEST 'died', otherwise 'home')
+    icu: Optional[float]
+        fraction of patients admitted to the IC department, from a random moment until the end of the stay
+    effect: Optional[float]
+        drift of the values of patients who die, in standard deviations at the moment of death
+    start: Optional[str]
+        admissions are spread over the 90 days from start
+    random_state: Optional[int]
+    categorical: Optional[bool]
+        if True, ID, DEST, DEPARTMENT and VARIABLE are returned as pd.Categorical, which needs much less memory
+
+    Returns
+    -------
+    df: pd.DataFrame
+    """
+    rng = np.random.default_rng(random_state)
+    variables = DEFAULT_VARIABLES if variables is None else variables
+    names = list(variables)
+    hour = np.int64(3600*10**9)
+
+    # per patient
+    ids = np.array(['S{:07d}'.format(i) for i in range(n_patients)])
+    admission = pd.Timestamp(start).value + (rng.uniform(0,90*24,n_patients)*hour).astype(np.int64)
+    los = np.maximum(rng.exponential(stay_hours,n_patients),6)
+    died = rng.random(n_patients) < mortality
+    icu_from = np.where(rng.random(n_patients) < icu,rng.uniform(0,1,n_patients)*los,np.inf)
+    age = np.clip(rng.normal(65,14,n_patients),18,100).round()
+    bmi = np.where(rng.random(n_patients) < missingness,np.nan,np.clip(rng.normal(27,5,n_patients),15,60).round(1))
+
+    # number of measurements per patient and variable
+    rate = np.array([variables[v][2] for v in names])*frequency
+    counts = rng.poisson(los[:,None]*rate[None,:]) + 1
+    counts[rng.random(counts.shape) < missingness] = 0
+    counts = counts.ravel()
+
+    patient = np.repeat(np.repeat(np.arange(n_patients),len(names)),counts)
+    variable = np.repeat(np.tile(np.arange(len(names)),n_patients),counts)
+    hours = rng.uniform(0,1,len(patient))*los[patient]
+
+    mean = np.array([variables[v][0] for v in names])[variable]
+    std = np.array([variables[v][1] for v in names])[variable]
+    direction = np.array([-1 if v == 'SpO2' else 1 for v in names])[variable] # SpO2 drops, the others rise
+    drift = np.where(died[patient],effect*np.exp(-(los[patient] - hours)/24),0)
+    values = mean + std*(rng.normal(size=len(patient)) + direction*drift)
+
+    # sorted by ID and TIME; string columns are built from categories, which avoids one string per row in between
+    times = admission[patient] + (hours*hour).astype(np.int64)
+    order = np.lexsort((times,patient))
+    patient,variable,times,values,icu_rows = patient[order],variable[order],times[order],values[order],(hours >= icu_from[patient])[order]
+
+    df = pd.DataFrame({'ID':pd.Categorical.from_codes(patient,ids),
+                       'BMI':bmi[patient],
+                       'AGE':age[patient],
+                       'DEST':pd.Categorical.from_codes(died[patient].astype(np.int8),['home','died']),
+                       'DEPARTMENT':pd.Categorical.from_codes(icu_rows.astype(np.int8),['WARD','IC']),
+                       'TIME':times.astype('datetime64[ns]'),
+                       'VARIABLE':pd.Categorical.from_codes(variable,names),
+                       'VALUE':values.round(2)})
+
+    if not categorical:
+        for col in ['ID','DEST','DEPARTMENT','VARIABLE']:
+            df[col] = pd.array(df[col].cat.categories.values,dtype=str).take(df[col].cat.codes.values)
+
+    return df
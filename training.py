@@ -0,0 +1,154 @@
+import os
+import time
+import tempfile
+import shutil
+import numpy as np
+import pandas as pd
+
+from evaluation import Evaluation
+from instrument import instrumented
+
+
+def _random_forest(params,threads,random_state):
+    from sklearn.ensemble import RandomForestClassifier
+
+    return RandomForestClassifier(**{'n_estimators':500,'max_depth':9,'max_features':'sqrt','n_jobs':threads,
+                                     'random_state':random_state,**params})
+
+
+def _logistic_regression(params,threads,random_state):
+    from sklearn.linear_model import LogisticRegression
+
+    return LogisticRegression(**{'C':1.0,'max_iter':1000,'random_state':random_state,**params})
+
+
+def _gradient_boosting(params,threads,random_state):
+    from sklearn.ensemble import HistGradientBoostingClassifier
+
+    return HistGradientBoostingClassifier(**{'learning_rate':0.1,'max_iter':300,'early_stopping':True,
+                                             'random_state':random_state,**params})
+
+
+# model name -> (function of (params, threads, random_state) that returns an unfitted classifier, relative fit cost).
+# The cost is only used to start the slowest fits first.
+MODELS = {'RF':(_random_forest,10),
+          'LR':(_logistic_regression,1),
+          'HGB':(_gradient_boosting,3)}
+
+
+def _spec(spec):
+    # 'RF' or ('RF',{'max_depth':5}) -> (name, params)
+    name,params = (spec,{}) if isinstance(spec,str) else (spec[0],dict(spec[1]))
+    if name not in MODELS:
+        raise ValueError('unknown model: ' + str(name))
+
+    return name,params
+
+
+_worker = {} # memory-mapped matrices of a worker process of train_models
+
+def _init_training_worker(folder):
+
+    _worker.update({name:np.load(os.path.join(folder,name + '.npy'),mmap_mode='r')
+                    for name in ['X_train','y_train','w_train','X_test','y_test'] if os.path.exists(os.path.join(folder,name + '.npy'))})
+
+
+def _fit_model(spec,threads,random_state):
+    # fits one candidate on the shared training matrix and scores it on the test matrix
+    from threadpoolctl import threadpool_limits
+
+    name,params = _spec(spec)
+    with threadpool_limits(threads):
+        clf = MODELS[name][0](params,threads,random_state)
+
+        start = time.perf_counter()
+        clf.fit(_worker['X_train'],_worker['y_train'],sample_weight=_worker.get('w_train'))
+        train_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        proba = clf.predict_proba(_worker['X_test'])[:,1]
+        predict_s = time.perf_counter() - start
+
+    return clf,{'model':name,'params':params,'auc':Evaluation(_worker['y_test'],proba).AUC(),'train_s':train_s,
+                'predict_per_s':len(proba)/predict_s if predict_s > 0 else None,'n_train':len(_worker['y_train'])}
+
+
+@instrumented('train_models',vectors=lambda a,out: out[0]['n_train'].iloc[0] if len(out[0]) else 0)
+def train_models(X_train,y_train,X_test,y_test,specs=('RF','LR','HGB'),indices=None,sample_weight=None,n_jobs=-1,
+                 folder=None,random_state=0):
+    """
+    Fits several models concurrently and compares them on the test set, like train_model, so the validation set stays
+    held out for the evaluation of the selected model. The training rows are written once to a memory-mapped .npy file
+    that all worker processes share, so no process holds a copy of its own. The slowest models are started first; if
+    there are fewer models than cores, every model gets several threads (n_jobs of the forest, OpenMP threads of
+    gradient boosting), so all cores stay busy.
+
+    Parameters
+    ----------
+    X_train: np.array
+        Train set feature matrix [N feature vectors x N variables]
+    y_train: np.array
+        Train set label vector
+    X_test: np.array
+        Test set feature matrix
+    y_test: np.array
+        Test set label vector
+    specs: Optional[list]
+        model names of MODELS ('RF', 'LR', 'HGB'), or (name, params) pairs, e.g. ('RF',{'max_depth':5})
+    indices: Optional[np.array]
+        rows of X_train and y_train to train on, e.g. from balance_indices
+    sample_weight: Optional[np.array]
+        weight per training row (after indices), e.g. from balance_weights
+    n_jobs: Optional[int]
+        Number of cores, -1 for all cores.
+    folder: Optional[str]
+        directory for the memory-mapped matrices, a temporary directory if None
+    random_state: Optional[int]
+
+    Returns
+    -------
+    leaderboard: pd.DataFrame
+        per model: test AUC, train time in seconds, predictions per second and number of training rows,
+        sorted by AUC
+    models: list
+        fitted classifiers, in the order of the leaderboard
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    n_jobs = os.cpu_count() if n_jobs < 1 else n_jobs
+    specs = list(specs)
+    order = sorted(range(len(specs)),key=lambda i: -MODELS[_spec(specs[i])[0]][1])
+    workers = min(n_jobs,len(specs))
+    threads = max(1,n_jobs//max(workers,1))
+
+    tmp = folder is None
+    folder = tempfile.mkdtemp(prefix='parchure_train_') if tmp else folder
+    os.makedirs(folder,exist_ok=True)
+    try:
+        # written in blocks of rows, so the balanced training matrix is never copied in memory
+        rows = np.arange(len(y_train)) if indices is None else np.asarray(indices)
+        for name,a,r in [('X_train',X_train,rows),('y_train',np.asarray(y_train),rows),
+                         ('X_test',X_test,np.arange(len(y_test))),('y_test',np.asarray(y_test),np.arange(len(y_test)))]:
+            out = np.lib.format.open_memmap(os.path.join(folder,name + '.npy'),mode='w+',dtype=a.dtype,
+                                            shape=(len(r),) + a.shape[1:])
+            for start in range(0,len(r),65536):
+                out[start:start + 65536] = a[r[start:start + 65536]]
+            out.flush()
+            del out
+        if sample_weight is not None:
+            np.save(os.path.join(folder,'w_train.npy'),np.asarray(sample_weight,dtype=float))
+
+        with ProcessPoolExecutor(max_workers=workers,initializer=_init_training_worker,initargs=(folder,)) as pool:
+            futures = {i:pool.submit(_fit_model,specs[i],threads,random_state) for i in order}
+            results = [futures[i].result() for i in range(len(specs))]
+    finally:
+        if tmp:
+            shutil.rmtree(folder,ignore_errors=True)
+
+    leaderboard = pd.DataFrame([r for _,r in results])
+    leaderboard = leaderboard.sort_values('auc',ascending=False,kind='mergesort')
+    models = [results[i][0] for i in leaderboard.index]
+
+    print(leaderboard.to_string(index=False))
+
+    return leaderboard.reset_index(drop=True),models